@@ -0,0 +1,23 @@
+"""
+Offline benchmarks. Run from the project root, e.g.:
+
+    python -m benchmarks.bench_extract
+"""
+import sys
+from pathlib import Path
+
+
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+
+
+try:
+    import CONFIG
+except ImportError:
+    # No local CONFIG.py: the defaults are enough for the offline runs
+    from social2tg import base_config as CONFIG
+    CONFIG.log_path = None
+    sys.modules['CONFIG'] = CONFIG
+
+
+def load_fixture(name):
+    return (FIXTURES / name).read_text()
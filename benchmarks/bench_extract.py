@@ -0,0 +1,59 @@
+"""
+Pages per second parsed by each installed Gramhir extraction engine
+"""
+import argparse
+import time
+
+from benchmarks import load_fixture
+from social2tg.extract import EXTRACTORS
+
+
+PAGES = {
+    'photo': 'gramhir_post_photo.html',
+    'video': 'gramhir_post_video.html',
+    'carousel': 'gramhir_post_carousel.html',
+}
+
+
+def pages_per_second(func, html, seconds):
+    count = 0
+    started = time.perf_counter()
+    while (elapsed := time.perf_counter() - started) < seconds:
+        func(html)
+        count += 1
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=1.0, help='time per engine and page')
+    args = parser.parse_args()
+
+    pages = {kind: load_fixture(name) for kind, name in PAGES.items()}
+    profile = load_fixture('gramhir_profile.html')
+
+    reference = None
+    for name, cls in EXTRACTORS.items():
+        try:
+            extractor = cls()
+        except ImportError:
+            print(f'{name:>10}: not installed')
+            continue
+
+        fields = {kind: extractor.extract_post(html) for kind, html in pages.items()}
+        if reference is None:
+            reference = fields
+        mark = '' if fields == reference else '  (fields differ!)'
+
+        results = [
+            f'{kind} {pages_per_second(extractor.extract_post, html, args.seconds):8.1f}'
+            for kind, html in pages.items()
+        ]
+        results.append(
+            f'profile {pages_per_second(extractor.extract_post_urls, profile, args.seconds):8.1f}'
+        )
+        print(f'{name:>10}: ' + ', '.join(results) + ' pages/s' + mark)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Memory taken by the gathered posts: bytes per GramhirPost with its media,
+after the page it was parsed from is dropped
+"""
+import argparse
+import gc
+import tracemalloc
+
+from benchmarks import load_fixture
+from social2tg.inst import GramhirPost
+from social2tg.utils import media_id_to_shortcode
+
+
+PAGES = ['gramhir_post_photo.html', 'gramhir_post_video.html', 'gramhir_post_carousel.html']
+
+
+def make_page(template, idx):
+    """
+    Distinct copy of the page, as every loaded page is
+    """
+    return template.replace('let short_code = "', f'let short_code = "{media_id_to_shortcode(str(idx + 1))}', 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=300, help='posts kept in memory')
+    args = parser.parse_args()
+
+    templates = [load_fixture(name) for name in PAGES]
+    GramhirPost({'url': 'warm-up', 'html': templates[0]})
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    posts = []
+    for idx in range(args.posts):
+        page = make_page(templates[idx % len(templates)], idx)
+        posts.append(GramhirPost({'url': f'https://www.picuki.com/media/{idx}', 'html': page}))
+        del page
+
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    media = sum(len(post.media) for post in posts)
+    print(f'{args.posts} posts with {media} media: {(after - before) / 1024:.1f} KiB, '
+          f'{(after - before) / args.posts:.0f} bytes per post')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Offline benchmark suite: parsing, target formatting, storage lookups
+and an end-to-end gather+publish cycle, on recorded pages, without network.
+Reports ops/s and peak memory, and compares them with the stored baseline
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks import CONFIG, load_fixture
+from social2tg.common import Feed
+from social2tg.inst import GramhirPost, GramhirRequestsSource
+from social2tg.storage import SqliteStorage
+from social2tg.tg import TelegramTarget
+from social2tg.utils import get_logger, media_id_to_shortcode
+
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'baseline.json'
+POST_FIXTURES = ['gramhir_post_photo.html', 'gramhir_post_video.html', 'gramhir_post_carousel.html']
+
+
+class FixtureGramhirSource(GramhirRequestsSource):
+    """
+    Gramhir source serving the recorded pages instead of the network.
+    Each post URL gets its own short code, derived from the URL as the real pages have
+    """
+    def http_get(self, url, headers=None):
+        if url == self.url:
+            return load_fixture('gramhir_profile.html')
+
+        media_id = url.rstrip('/').rsplit('/', 1)[-1]
+        html = load_fixture(POST_FIXTURES[int(media_id) % len(POST_FIXTURES)])
+        start = html.index('let short_code = "') + len('let short_code = "')
+        end = html.index('"', start)
+        return html[:start] + media_id_to_shortcode(media_id) + html[end:]
+
+
+class StubTarget(TelegramTarget):
+    """
+    Telegram target which prepares the message, but sends nothing
+    """
+    def publish(self, update):
+        text, footer, media = update.to_internal()
+        self.to_target(text, footer, media)
+        return True
+
+
+def configure():
+    """
+    Register the fixture source, stub target and their feed, disable the pauses
+    """
+    get_logger().setLevel(logging.WARNING)
+    CONFIG.gramhir_host = 'www.picuki.com'
+    CONFIG.http_cache = None
+    CONFIG.media_cache = None
+    CONFIG.default_rate_limit = {'rate': 10 ** 9, 'burst': 10 ** 9}
+    CONFIG.rate_limits = {}
+    CONFIG.sources = {'bench_source': {'class': f'{__name__}.FixtureGramhirSource', 'id': 'nickname'}}
+    CONFIG.targets = {
+        'bench_target_1': {'class': f'{__name__}.StubTarget', 'chat_id': -1},
+        'bench_target_2': {'class': f'{__name__}.StubTarget', 'chat_id': -2, 'no_footer': True},
+    }
+    CONFIG.feeds = {
+        'bench_feed': {
+            'sources': ['bench_source'],
+            'targets': ['bench_target_1', 'bench_target_2'],
+            'storage': {'class': 'social2tg.storage.MemoryStorage'},
+        },
+    }
+
+
+def make_history(path, rows):
+    """
+    Create Sqlite storage with the history of published updates
+    """
+    storage = SqliteStorage({'path': path})
+    storage.close()
+
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    batch = 100_000
+    for start in range(0, rows, batch):
+        conn.executemany(
+            'INSERT INTO published (update_id, feed, target, at) VALUES (?, ?, ?, ?)',
+            (
+                (f'id{idx}', f'feed{idx % 200}', f'target{idx % 3}', now)
+                for idx in range(start, min(start + batch, rows))
+            ),
+        )
+    conn.commit()
+    conn.close()
+    return SqliteStorage({'path': path})
+
+
+def measure(func, min_time):
+    """
+    Return ops/s of the function, and peak memory of one call in KiB
+    """
+    func()  # warm up
+
+    count = 0
+    started = time.perf_counter()
+    while (elapsed := time.perf_counter() - started) < min_time:
+        func()
+        count += 1
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'ops_per_sec': round(count / elapsed, 2), 'peak_kib': round(peak / 1024, 1)}
+
+
+def build_benchmarks(storage):
+    source = FixtureGramhirSource('bench_source', CONFIG.sources['bench_source'])
+    source.last_resp_text = load_fixture('gramhir_profile.html')
+    pages = {name: load_fixture(name) for name in POST_FIXTURES}
+    target = StubTarget('bench_target_1', CONFIG.targets['bench_target_1'])
+    long_text = ' '.join(['lorem ipsum dolor sit amet'] * 400)
+    footer = '\n\n<i><a href="https://www.instagram.com/p/x/">Post</a> by <code>@nickname</code></i>'
+
+    feed = type('HistoryFeed', (), {'name': 'feed7'})()
+    history_target = type('HistoryTarget', (), {'name': 'target1'})()
+    rng = random.Random(1)
+
+    def storage_lookup():
+        storage.find_published_id(f'id{rng.randrange(2 * 10 ** 6)}', feed, history_target)
+
+    def gather_publish():
+        bench_feed = Feed('bench_feed', CONFIG.feeds['bench_feed'])
+        bench_feed.publish(bench_feed.gather())
+        bench_feed.close()
+
+    benchmarks = {
+        'parse_post_urls': source._parse_post_urls,
+        'to_target_caption': lambda: target.to_target(long_text, footer, ['media']),
+        'to_target_text': lambda: target.to_target(long_text, footer, []),
+        'storage_lookup': storage_lookup,
+        'storage_load_published': lambda: storage.load_published(feed, history_target),
+        'gather_publish_cycle': gather_publish,
+    }
+    for name, html in pages.items():
+        kind = name.rsplit('_', 1)[-1].split('.')[0]
+        benchmarks[f'gramhir_post_{kind}'] = lambda html=html: GramhirPost({'url': 'u', 'html': html})
+
+    return benchmarks
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change against the baseline, return names of the regressed benchmarks
+    """
+    regressed = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+        mark = ''
+        if ratio < 1 - tolerance:
+            mark = '  REGRESSION'
+            regressed.append(name)
+        print(f'{name:>28}: {ratio - 1:+7.1%} ops/s vs baseline{mark}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=1.0, help='time per benchmark')
+    parser.add_argument('--history-rows', type=int, default=10 ** 6, help='rows in the storage')
+    parser.add_argument('--only', nargs='*', help='run only these benchmarks')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    configure()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f'Creating storage with {args.history_rows} rows...')
+        storage = make_history(os.path.join(tmp_dir, 'history.sqlite'), args.history_rows)
+
+        results = {}
+        for name, func in build_benchmarks(storage).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(func, args.seconds)
+            print(f"{name:>28}: {results[name]['ops_per_sec']:12.2f} ops/s, "
+                  f"peak {results[name]['peak_kib']:10.1f} KiB")
+        storage.close()
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        print(f'Baseline saved to {args.baseline}')
+    elif args.baseline.exists():
+        print()
+        if compare(results, json.loads(args.baseline.read_text()), args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Publishing throughput against the local Bot API stand-in:
+messages per second and the time spent waiting out the flood limits,
+for the given publishing schedule and injected failures
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import CONFIG
+from benchmarks.fake_bot_api import FakeBotApi
+from social2tg.common import Image, Post, Video
+from social2tg.metrics import METRICS
+from social2tg.tg import PtbChatTarget
+from social2tg.utils import get_logger
+
+
+class BenchPost(Post):
+    """
+    Post with the text and the media given right away
+    """
+    def __init__(self, idx, media_count):
+        super().__init__({'id': idx})
+        self._url = f'https://www.instagram.com/p/bench{idx}/'
+        self._author = 'bench'
+        self._text = f'Benchmark post {idx} ' + 'lorem ipsum ' * 50
+        self._media = [
+            (Video if num % 3 == 2 else Image)(url=f'https://cdn.example.com/{idx}/{num}.jpg')
+            for num in range(media_count)
+        ]
+
+    @property
+    def identifier(self):
+        return self._url
+
+
+def make_schedule(count, media_every, media_count):
+    """
+    Posts to publish: every `media_every`-th is an album, the rest are texts
+    """
+    return [
+        BenchPost(idx, media_count if media_every and idx % media_every == 0 else 0)
+        for idx in range(count)
+    ]
+
+
+def publish_all(target, posts):
+    published = 0
+    for post in posts:
+        try:
+            if target.publish(post):
+                published += 1
+        except Exception as exc:
+            print(f'{target}: {post} failed: {exc!r}')
+    return published
+
+
+def flood_wait_seconds():
+    return sum(
+        counter['value'] for counter in METRICS.summary()['counters']
+        if counter['name'] == 'telegram_flood_wait_seconds'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--posts', type=int, default=50, help='posts per target')
+    parser.add_argument('--targets', type=int, default=2, help='chats published to in parallel')
+    parser.add_argument('--media-every', type=int, default=3, help='every Nth post is an album, 0 for none')
+    parser.add_argument('--media-count', type=int, default=4, help='items in an album')
+    parser.add_argument('--min-interval', type=float, default=0, help='seconds between messages in a chat')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of the server latency')
+    parser.add_argument('--flood-rate', type=float, default=0, help='share of requests answered by 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds the 429 responses ask to wait')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered by 400')
+    parser.add_argument('--chat-limit', type=int, help='messages per chat window before 429')
+    parser.add_argument('--chat-window', type=float, default=60, help='seconds of the chat window')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    get_logger().setLevel(logging.WARNING)
+    CONFIG.media_cache = None
+
+    api = FakeBotApi(
+        latency=args.latency, flood_rate=args.flood_rate, retry_after=args.retry_after,
+        error_rate=args.error_rate, chat_limit=args.chat_limit, chat_window=args.chat_window,
+        seed=args.seed,
+    ).start()
+
+    targets = [
+        PtbChatTarget(f'bench_target_{num}', {
+            'bot_token': '123456:fake',
+            'chat_id': -1000 - num,
+            'base_url': api.base_url,
+            'min_interval': args.min_interval,
+        })
+        for num in range(args.targets)
+    ]
+    posts = make_schedule(args.posts, args.media_every, args.media_count)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        published = sum(pool.map(lambda target: publish_all(target, posts), targets))
+    elapsed = time.perf_counter() - started
+    api.close()
+
+    stats = api.stats
+    print(f'Published {published} of {len(posts) * len(targets)} posts in {elapsed:.2f} s')
+    print(f"Messages delivered: {stats['messages']}, {stats['messages'] / elapsed:.1f} messages/s")
+    print(f"Requests: {stats['requests']}, 429: {stats['floods']}, 400: {stats['bad_requests']}")
+    print(f"Flood wait asked by the server: {stats['flood_wait_seconds']} s, "
+          f"waited by the targets: {flood_wait_seconds()} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Local stand-in of Telegram Bot API, for load-testing the publishing.
+Serves sendMessage, sendMediaGroup and getFile, and can inject
+latency, 429 flood limits and 400 errors.
+Point PtbChatTarget at it with the "base_url" param:
+
+    api = FakeBotApi(latency=0.05, flood_rate=0.1).start()
+    params = {'bot_token': '1:fake', 'chat_id': -1, 'base_url': api.base_url}
+"""
+import collections
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+class FakeBotApi:
+    """
+    Bot API server in a background thread. Params:
+    - "latency": seconds every response is delayed by
+    - "flood_rate": share of the sending requests answered by 429
+    - "retry_after": seconds the 429 responses ask to wait
+    - "error_rate": share of the sending requests answered by 400
+    - "chat_limit", "chat_window": like Telegram, answer 429 when a chat gets more
+      than `chat_limit` messages in `chat_window` seconds, until the window frees
+    """
+    SENDING = ('sendMessage', 'sendMediaGroup')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, flood_rate=0, retry_after=1,
+                 error_rate=0, chat_limit=None, chat_window=60, seed=None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.chat_limit = chat_limit
+        self.chat_window = chat_window
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sent = collections.defaultdict(collections.deque)  # chat_id: times of the messages
+        self.stats = collections.Counter()
+
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def _str(self):
+        return f"FakeBotApi('{self.base_url}')"
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+    @property
+    def base_url(self):
+        """
+        Base URL for PTB, the token is appended to it
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                status, payload = api.handle(method, parse_body(self.headers, body))
+                self._respond(status, payload)
+
+            do_GET = do_POST
+
+            def _respond(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method, data):
+        """
+        Return HTTP status and JSON payload of the response to the API method
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats[f'requests_{method}'] += 1
+
+            if method in self.SENDING:
+                if error := self._injected_error(data):
+                    return error
+            if method == 'sendMessage':
+                return 200, ok(self._send_message(data))
+            if method == 'sendMediaGroup':
+                return 200, ok(self._send_media_group(data))
+            if method == 'getFile':
+                return 200, ok(self._get_file(data))
+
+            self.stats['not_found'] += 1
+            return 404, failed(404, 'Not Found')
+
+    def _injected_error(self, data):
+        chat_id = str(data.get('chat_id'))
+        now = time.monotonic()
+
+        if self.chat_limit:
+            sent = self._sent[chat_id]
+            while sent and sent[0] <= now - self.chat_window:
+                sent.popleft()
+            if len(sent) >= self.chat_limit:
+                retry_after = max(1, round(sent[0] + self.chat_window - now))
+                return self._flood(retry_after)
+
+        if self._random.random() < self.flood_rate:
+            return self._flood(self.retry_after)
+
+        if self._random.random() < self.error_rate:
+            self.stats['bad_requests'] += 1
+            return 400, failed(400, 'Bad Request: injected error')
+
+        self._sent[chat_id].append(now)
+        return None
+
+    def _flood(self, retry_after):
+        self.stats['floods'] += 1
+        self.stats['flood_wait_seconds'] += retry_after
+        return 429, failed(
+            429, f'Too Many Requests: retry after {retry_after}', {'retry_after': retry_after})
+
+    def _message(self, data, **fields):
+        self.stats['messages'] += 1
+        chat_id = int(data.get('chat_id') or 0)
+        return {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'channel' if chat_id < 0 else 'private'},
+            **fields,
+        }
+
+    def _file(self, media):
+        """
+        Uploaded files and URLs get new file_ids, file_ids are kept
+        """
+        if isinstance(media, str) and media.startswith('fake-file-'):
+            file_id = media
+        else:
+            file_id = f'fake-file-{next(self._ids)}'
+        return {'file_id': file_id, 'file_unique_id': file_id, 'width': 1080, 'height': 1080}
+
+    def _send_message(self, data):
+        return self._message(data, text=data.get('text', ''))
+
+    def _send_media_group(self, data):
+        media = data.get('media') or []
+        if isinstance(media, str):
+            media = json.loads(media)
+
+        messages = []
+        for item in media:
+            file = self._file(item.get('media'))
+            if item.get('type') == 'video':
+                messages.append(self._message(data, video={**file, 'duration': 10}))
+            else:
+                messages.append(self._message(data, photo=[file]))
+        return messages
+
+    def _get_file(self, data):
+        file_id = data.get('file_id', '')
+        return {
+            'file_id': file_id,
+            'file_unique_id': file_id,
+            'file_size': 0,
+            'file_path': f'files/{file_id}',
+        }
+
+
+def ok(result):
+    return {'ok': True, 'result': result}
+
+
+def failed(code, description, parameters=None):
+    payload = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        payload['parameters'] = parameters
+    return payload
+
+
+def parse_body(headers, body):
+    """
+    Return the request params, sent as JSON, a form, or multipart with the uploads
+    """
+    content_type = headers.get('Content-Type', '')
+    if not body:
+        return {}
+
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        data = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is None:
+                data[name] = part.get_payload(decode=True).decode()
+            else:
+                data[name] = part.get_filename()
+        return data
+
+    return dict(parse_qsl(body.decode()))
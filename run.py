@@ -1,9 +1,12 @@
+import argparse
 import os
 import ssl
 import time
 
 import CONFIG
-from social2tg.common import Feed, cleanup
+from social2tg import metrics
+from social2tg.common import cleanup
+from social2tg.scheduler import FeedDaemon, FeedScheduler
 from social2tg.utils import get_logger
 
 
@@ -16,34 +19,33 @@ def handle_connection():
             lambda self: ssl.CERT_NONE, lambda self, newval: None)
 
     if CONFIG.tor_proxy:
-        os.environ['http_proxy'] = 'socks5h://localhost:9050'
-        os.environ['https_proxy'] = 'socks5h://localhost:9050'
-
         logger.info('Restarting Tor')
         os.system('sudo systemctl restart tor')
         time.sleep(10)
 
-    elif CONFIG.proxy:
-        os.environ['http_proxy'] = CONFIG.proxy
-        os.environ['https_proxy'] = CONFIG.proxy
-
 
-def process_feed(name):
-    feed_params = CONFIG.feeds[name]
-    feed = Feed(name, feed_params)
-    updates = feed.gather()
-    feed.publish(updates)
-    time.sleep(CONFIG.delay_after_source)
+def parse_args():
+    parser = argparse.ArgumentParser(description='Publish updates of the feeds from CONFIG.py')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running, processing each feed every its interval')
+    return parser.parse_args()
 
 
 def main():
     """
     Gather updates and publish it for each Feed from settings
     """
+    args = parse_args()
     handle_connection()
-
-    for feed_name in CONFIG.feeds:
-        process_feed(feed_name)
+    metrics.serve()
+
+    if args.daemon:
+        daemon = FeedDaemon(CONFIG.feeds)
+        daemon.install_signal_handlers()
+        daemon.run()
+    else:
+        FeedScheduler(CONFIG.feeds).run()
 
     cleanup()
 
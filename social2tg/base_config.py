@@ -7,13 +7,52 @@ base_dir = Path(__file__).resolve(strict=True).parent.parent
 log_path = base_dir / 'log.txt'
 
 browser_headless = True
+browser_pool_size = 1  # Firefox instances loading pages at once
+browser_max_pages = 200  # a browser is restarted after so many page loads
+browser_max_rss_mb = None  # ...or when its processes take more memory, e.g. 1500
+page_ready_timeout = 15  # seconds the browser waits for the page readiness condition
+gramhir_profile_ready_posts = 1  # posts on the profile page meaning it's loaded
+geckodriver_path = None  # if not set, it's looked up once and remembered in geckodriver_cache
+geckodriver_cache = base_dir / '.geckodriver_path'
 tor_proxy = False
 proxy = None
 disable_ssl = False
 
 gramhir_host = '167.172.252.123'  # or 'gramhir.com', 'picuki.com', 'www.picuki.com'
 gramhir_host_header = 'www.picuki.com'
+html_extractor = 'auto'  # or 'selectolax', 'lxml', 'soup'
+parse_processes = 0  # processes parsing the post pages while the next ones load; 0 parses in the loading thread
+
+http_backend = 'requests'  # or 'httpx', for the async client with a shared connection pool; Tor needs "httpx[socks]"
+http2 = False  # httpx only, requires "httpx[http2]"
+http_pool_size = 20  # connections kept by httpx, and pages loaded at once by a source
+
+# On-disk cache of the pages loaded by requests/httpx, revalidated with ETag/Last-Modified.
+# "freshness" is {URL regex: seconds the page is served without asking the server}
+http_cache = None  # e.g. {'path': base_dir / 'http_cache', 'max_size': 200 * 2**20,
+                   #       'freshness': {'/media/': 30 * 24 * 3600, '/profile/': 0}}
+
+# Media downloaded once for all the Telegram targets, and file_ids of their uploads.
+# The least recently used files are removed above "max_size" bytes
+media_cache = None  # e.g. {'path': base_dir / 'media_cache', 'max_size': 2 * 2**30}
 
-delay_after_post = 3
-delay_after_source = 5
 delay_after_any_request = 3
+
+max_concurrent_feeds = 8  # feeds processed at once
+shared_updates_max_age = 60  # daemon only: seconds the updates of a source are reused by the other feeds using it
+publish_queue_size = 10  # updates gathered ahead of the slowest target of a feed
+
+# Durable queue of the updates to publish. Failed ones are retried with exponential backoff
+# from "backoff" up to "max_backoff" seconds, without scraping them again. Needed for Target.schedule()
+outbox = None  # e.g. {'path': base_dir / 'outbox.sqlite', 'max_attempts': 8, 'backoff': 60}
+feed_interval = 60 * 60  # daemon mode: seconds or timedelta between processing a feed, or its "interval"
+max_requests_per_host = 1  # requests in flight to the same host
+
+# Token bucket of each host: sustained "rate" in requests per second, and "burst" requests.
+# By default it's 1 request per delay_after_any_request
+default_rate_limit = None  # e.g. {'rate': 0.5, 'burst': 3}
+rate_limits = {}  # per host, e.g. {'www.picuki.com': {'rate': 0.2, 'burst': 5}}
+
+metrics_textfile = None  # Prometheus textfile, e.g. base_dir / 'social2tg.prom'
+metrics_port = None  # serve Prometheus metrics over HTTP, e.g. 9464
+metrics_summary_path = None  # JSON summary of the run, e.g. base_dir / 'last_run.json'
@@ -1,33 +1,52 @@
 import warnings
 warnings.filterwarnings('ignore')
 
+import asyncio
+import logging
+import os
+import shutil
+import threading
 import time
-
-import requests
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.firefox.service import Service as FirefoxService
-from webdriver_manager.firefox import GeckoDriverManager
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
 
 import CONFIG
+from . import metrics
 from .constants import HEADERS_LIKE_BROWSER
-from .utils import get_logger
+from .httpcache import HttpCache
+from .utils import get_logger, on_cleanup
 
 
-_browser = None
+_browser_pool = None
+_browser_pool_lock = threading.Lock()
+_firefox_browser_class = None
+_firefox_browser_class_lock = threading.Lock()
 _reqclient = None
+_reqclient_lock = threading.Lock()
 logger = get_logger()
 
 
+def get_proxy():
+    """
+    Return URL of the proxy the sources go through, if any.
+    It's given to each client, the environment is left intact
+    """
+    if CONFIG.tor_proxy:
+        return 'socks5h://localhost:9050'
+    return CONFIG.proxy
+
+
 class Client:
 
     def get(self):
         raise NotImplementedError
 
-    def scroll_up_down(self):
-        pass
+    def get_fresh(self, url):
+        """
+        Return response which may be used without a request, if any
+        """
+        return None
 
 
 class RequestsClient(Client):
@@ -35,11 +54,12 @@ class RequestsClient(Client):
     Wrapper on Requests Session
     """
     def __init__(self):
+        import requests
         self._session = requests.session()
 
-        if CONFIG.tor_proxy:
-            self._session.proxies['http'] = 'socks5h://localhost:9050'
-            self._session.proxies['https'] = 'socks5h://localhost:9050'
+        if proxy := get_proxy():
+            self._session.proxies['http'] = proxy
+            self._session.proxies['https'] = proxy
 
     def get(self, url, *args, **kwargs):
         headers = HEADERS_LIKE_BROWSER.copy()
@@ -53,17 +73,154 @@ class RequestsClient(Client):
         return resp
 
 
-class FirefoxBrowser(webdriver.Firefox, Client):
+class HttpxClient(Client):
+    """
+    Wrapper on httpx AsyncClient, working in its own event loop thread.
+    One keep-alive connection pool is shared by all the sources,
+    and many requests may be in flight at once
+    """
+    def __init__(self):
+        import httpx
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='httpx', daemon=True)
+        self._thread.start()
+
+        self._session = httpx.AsyncClient(
+            http2=CONFIG.http2,
+            verify=False,
+            proxy=get_proxy(),
+            trust_env=False,
+            follow_redirects=True,
+            timeout=httpx.Timeout(30),
+            limits=httpx.Limits(
+                max_connections=CONFIG.http_pool_size,
+                max_keepalive_connections=CONFIG.http_pool_size,
+            ),
+        )
+
+    def run(self, coro):
+        """
+        Run the coroutine in the client's loop and wait for the result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def aget(self, url, headers=None, **kwargs):
+        all_headers = HEADERS_LIKE_BROWSER.copy()
+        all_headers.update(headers or {})
+        return await self._session.get(url, headers=all_headers, **kwargs)
+
+    def get(self, url, *args, **kwargs):
+        return self.run(self.aget(url, *args, **kwargs))
+
+    def close(self):
+        try:
+            self.run(self._session.aclose())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+class CachingClient(Client):
+    """
+    Serve requests of the wrapped client from the HTTP cache,
+    revalidating stale entries with conditional requests
+    """
+    def __init__(self, client, cache):
+        self._client = client
+        self.cache = cache
+
+    def get_fresh(self, url):
+        meta = self.cache.lookup(url)
+        if meta and self.cache.is_fresh(meta):
+            if resp := self.cache.load(meta):
+                logger.info('Cache hit: %s', url)
+                return resp
+
+    def get(self, url, *args, **kwargs):
+        if resp := self.get_fresh(url):
+            return resp
+
+        meta = self.cache.lookup(url)
+
+        if meta:
+            kwargs['headers'] = {**kwargs.get('headers', {}), **self.cache.validators(meta)}
+
+        resp = self._client.get(url, *args, **kwargs)
+
+        if resp.status_code == 304 and meta:
+            if cached := self.cache.load(meta, revalidated=True):
+                logger.info('Not modified: %s', url)
+                return cached
+            kwargs['headers'] = {
+                name: value for name, value in kwargs['headers'].items()
+                if name not in ('If-None-Match', 'If-Modified-Since')
+            }
+            resp = self._client.get(url, *args, **kwargs)
+
+        self.cache.store(url, resp)
+        return resp
+
+    def close(self):
+        if isinstance(self._client, HttpxClient):
+            self._client.close()
+
+
+class Readiness:
+    """
+    Condition of a page being loaded, for the browser to wait for
+    """
+    def __call__(self, driver):
+        raise NotImplementedError
+
+
+class ElementsPresent(Readiness):
+    """
+    At least `count` elements matching the CSS selector are on the page
+    """
+    def __init__(self, selector, count=1):
+        self.selector = selector
+        self.count = count
+
+    def __str__(self):
+        return f'{self.count}+ {self.selector}'
+
+    def __call__(self, driver):
+        from selenium.webdriver.common.by import By
+        return len(driver.find_elements(By.CSS_SELECTOR, self.selector)) >= self.count
+
+
+class SourceContains(Readiness):
+    """
+    The page source contains the text
+    """
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return f"'{self.text}' in source"
+
+    def __call__(self, driver):
+        return self.text in driver.page_source
+
+
+class FirefoxBrowserMixin:
     """
-    Wrapper on Selenium driver
+    Our part of the Selenium driver wrapper, see get_firefox_browser_class()
     """
     def __init__(self):
+        from selenium.webdriver.firefox.options import Options
+        from selenium.webdriver.firefox.service import Service as FirefoxService
+
         options = Options()
         options.headless = CONFIG.browser_headless
 
         options.set_preference('permissions.default.image', 2)
         options.set_preference('dom.ipc.plugins.enabled.libflashplayer.so', False)
         options.set_preference('places.history.enabled', False)
+        # Don't wait for all the subresources, readiness conditions tell when the page is usable
+        options.page_load_strategy = 'eager'
 
         if CONFIG.tor_proxy:
             options.set_preference("network.dns.blockDotOnion", False)
@@ -72,25 +229,188 @@ class FirefoxBrowser(webdriver.Firefox, Client):
             options.set_preference("network.proxy.socks", "127.0.0.1")
             options.set_preference("network.proxy.socks_port", 9050)
             options.set_preference("network.proxy.socks_remote_dns", True)
+        elif CONFIG.proxy:
+            proxy = urlsplit(CONFIG.proxy)
+            options.set_preference("network.proxy.type", 1)
+            if proxy.scheme.startswith('socks'):
+                options.set_preference("network.proxy.socks_version", 4 if proxy.scheme == 'socks4' else 5)
+                options.set_preference("network.proxy.socks", proxy.hostname)
+                options.set_preference("network.proxy.socks_port", proxy.port)
+                options.set_preference("network.proxy.socks_remote_dns", proxy.scheme == 'socks5h')
+            else:
+                for scheme in ('http', 'ssl'):
+                    options.set_preference(f"network.proxy.{scheme}", proxy.hostname)
+                    options.set_preference(f"network.proxy.{scheme}_port", proxy.port)
 
-        service = FirefoxService(GeckoDriverManager().install())
+        service = FirefoxService(get_geckodriver_path())
         super().__init__(options=options, service=service)
+        self.pages = 0
 
     def __del__(self):
         self.quit()
 
     def css_select(self, selector):
+        from selenium.common.exceptions import NoSuchElementException
+        from selenium.webdriver.common.by import By
         try:
             return self.find_element(By.CSS_SELECTOR, selector)
         except NoSuchElementException as exc:
             logger.error(str(exc))
 
-    def scroll_up_down(self):
-        logger.info('Scrolling up and down in the browser')
-        self.execute_script('window.scrollTo(0, 0)')
-        time.sleep(1)
-        self.execute_script('window.scrollTo(0, document.body.scrollHeight)')
-        time.sleep(2)
+    def wait_ready(self, condition, timeout):
+        """
+        Wait until the page satisfies the condition. Return whether it did
+        """
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        started = time.monotonic()
+        try:
+            WebDriverWait(self, timeout, poll_frequency=0.2).until(condition)
+            ready = True
+        except TimeoutException:
+            ready = False
+
+        waited = time.monotonic() - started
+        metrics.observe('page_ready_wait', waited, condition=type(condition).__name__)
+        if not ready:
+            metrics.inc('page_ready_timeouts', condition=type(condition).__name__)
+        if ready:
+            logger.info('Page ready (%s) in %.2fs', condition, waited)
+        else:
+            logger.warning('Page not ready (%s) after %.2fs', condition, waited)
+        return ready
+
+    def get_rss_mb(self):
+        """
+        Return memory taken by the driver and the browser processes.
+        The browser is usually the driver's child, then it's counted once
+        """
+        pids = [self.service.process.pid]
+        if browser_pid := self.capabilities.get('moz:processID'):
+            pids.append(browser_pid)
+        return get_rss_mb(*pids)
+
+
+def get_firefox_browser_class():
+    """
+    Return FirefoxBrowser, the wrapper on Selenium driver, creating if necessarry.
+    Selenium is imported here, so the runs without browser sources don't load it
+    """
+    global _firefox_browser_class
+    with _firefox_browser_class_lock:
+        if _firefox_browser_class is None:
+            from selenium import webdriver
+
+            class FirefoxBrowser(FirefoxBrowserMixin, webdriver.Firefox, Client):
+                """
+                Wrapper on Selenium driver
+                """
+
+            _firefox_browser_class = FirefoxBrowser
+    return _firefox_browser_class
+
+
+def __getattr__(name):
+    if name == 'FirefoxBrowser':
+        return get_firefox_browser_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def get_geckodriver_path():
+    """
+    Return path of geckodriver: the configured one, the one found by an earlier run,
+    the one in PATH, or the one downloaded by webdriver_manager,
+    which asks GitHub for the latest release each time, so it's remembered
+    """
+    if CONFIG.geckodriver_path:
+        return str(CONFIG.geckodriver_path)
+
+    cache = Path(CONFIG.geckodriver_cache) if CONFIG.geckodriver_cache else None
+    if cache and cache.exists():
+        path = cache.read_text().strip()
+        if os.access(path, os.X_OK):
+            return path
+
+    path = shutil.which('geckodriver')
+    if path is None:
+        from webdriver_manager.firefox import GeckoDriverManager
+        path = GeckoDriverManager().install()
+
+    if cache:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            cache.write_text(path)
+        except OSError as exc:
+            logger.warning('Cant remember geckodriver path in %s: %s', cache, exc)
+    return path
+
+
+class BrowserPool:
+    """
+    Pool of Firefox instances, each used by one page load at a time.
+    A browser is recycled after `max_pages` page loads,
+    or when it takes more than `max_rss_mb` of memory
+    """
+    def __init__(self, size, max_pages=None, max_rss_mb=None):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _str(self):
+        return f'BrowserPool({self.size})'
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+    def _is_worn_out(self, browser):
+        if self.max_pages and browser.pages >= self.max_pages:
+            return True
+        if self.max_rss_mb and browser.get_rss_mb() > self.max_rss_mb:
+            return True
+        return False
+
+    @contextmanager
+    def browser(self):
+        """
+        Check out a browser for a page load
+        """
+        with self._semaphore:
+            with self._lock:
+                browser = self._idle.pop() if self._idle else None
+            if browser is None:
+                logger.info('Starting a browser for %s', self)
+                browser = get_firefox_browser_class()()
+
+            ok = False
+            try:
+                yield browser
+                ok = True
+            finally:
+                browser.pages += 1
+                if ok and not self._is_worn_out(browser):
+                    with self._lock:
+                        self._idle.append(browser)
+                else:
+                    logger.info('Recycling a browser after %s pages', browser.pages)
+                    browser.quit()
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().quit()
+
+
+HTTP_BACKENDS = {
+    'requests': RequestsClient,
+    'httpx': HttpxClient,
+}
 
 
 def get_reqclient():
@@ -98,21 +418,75 @@ def get_reqclient():
     Return requests client object, creating if necessarry
     """
     global _reqclient
-    if _reqclient is None:
-        _reqclient = RequestsClient()
+    with _reqclient_lock:
+        if _reqclient is None:
+            _reqclient = HTTP_BACKENDS[CONFIG.http_backend]()
+            if CONFIG.http_cache:
+                _reqclient = CachingClient(_reqclient, HttpCache(CONFIG.http_cache))
     return _reqclient
 
 
-def get_browser():
+@on_cleanup
+def destroy_reqclient():
+    global _reqclient
+    with _reqclient_lock:
+        if isinstance(_reqclient, (HttpxClient, CachingClient)):
+            _reqclient.close()
+        _reqclient = None
+
+
+def get_browser_pool():
     """
-    Return Selenium driver object, creating if necessarry
+    Return pool of Selenium drivers, creating if necessarry
     """
-    global _browser
-    if _browser is None:
-        _browser = FirefoxBrowser()
-    return _browser
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is None:
+            _browser_pool = BrowserPool(
+                CONFIG.browser_pool_size, CONFIG.browser_max_pages, CONFIG.browser_max_rss_mb)
+    return _browser_pool
 
 
-def destroy_browser():
-    if _browser is not None:
-        _browser.quit()
+def destroy_browser_pool():
+    global _browser_pool
+    with _browser_pool_lock:
+        if _browser_pool is not None:
+            _browser_pool.close()
+            _browser_pool = None
+
+
+def get_process_tree(pid):
+    """
+    Return pids of the process and all its descendants
+    """
+    pids = {pid}
+    for children in Path(f'/proc/{pid}/task').glob('*/children'):
+        try:
+            child_pids = children.read_text().split()
+        except OSError:
+            continue
+        for child in child_pids:
+            pids |= get_process_tree(int(child))
+    return pids
+
+
+def get_rss_mb(*pids):
+    """
+    Return resident memory of the processes and their children, in megabytes.
+    Each process is counted once, even if it's in several of the trees
+    """
+    tree = set()
+    for pid in pids:
+        tree |= get_process_tree(pid)
+
+    rss_kb = 0
+    for pid in tree:
+        try:
+            status = Path(f'/proc/{pid}/status').read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith('VmRSS:'):
+                rss_kb += int(line.split()[1])
+
+    return rss_kb / 1024
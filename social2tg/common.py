@@ -1,12 +1,17 @@
+import queue
 import random
+import threading
 import time
-
-from bs4 import BeautifulSoup
-from telegram import InputMediaPhoto, InputMediaVideo
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import CONFIG
-from .clients import destroy_browser, get_browser, get_reqclient
-from .utils import get_logger, import_string
+from .clients import destroy_browser_pool, get_browser_pool, get_reqclient
+from . import metrics
+from .outbox import get_outbox
+from .ratelimit import get_host, host_slot
+from .utils import get_logger, import_string, run_cleanups
 
 
 logger = get_logger()
@@ -15,18 +20,21 @@ logger = get_logger()
 class Update:
     """
     Base class of an Update, in any social source.
-    Update is any update entity such as post, story, etc
-    """
-    _url = None
-    _author = None
-    _date = None
-    _text = None
-    _media = None
-    orig_url = None
+    Update is any update entity such as post, story, etc.
+    Updates are compact records: the fields are slots, filled once
+    by the source, and nothing of the page they came from is kept
+    """
+    __slots__ = ('params', '_url', '_author', '_date', '_text', '_media', 'orig_url')
     update_type = None
 
     def __init__(self, params):
         self.params = params
+        self._url = None
+        self._author = None
+        self._date = None
+        self._text = None
+        self._media = None
+        self.orig_url = None
 
     def _str(self):
         return f"Update('{self._url}')"
@@ -82,11 +90,45 @@ class Update:
         media = self.media or []
         return text, footer, media
 
+    def to_record(self):
+        """
+        Return JSON-serializable dict of the update, to restore it by from_record()
+        """
+        return {
+            'class': f'{type(self).__module__}.{type(self).__qualname__}',
+            'url': self._url,
+            'author': self._author,
+            'date': self._date.isoformat() if self._date else None,
+            'text': self._text,
+            'orig_url': self.orig_url,
+            'media': [md.to_record() for md in self.media or []],
+        }
+
+    def _load_record(self, record):
+        self._url = record['url']
+        self._author = record['author']
+        self._date = datetime.fromisoformat(record['date']) if record['date'] else None
+        self._text = record['text']
+        self.orig_url = record['orig_url']
+        self._media = [Media.from_record(md) for md in record['media']]
+
+    @staticmethod
+    def from_record(record):
+        """
+        Restore the update of the recorded class, without asking its source again
+        """
+        cls = import_string(record['class'])
+        update = cls.__new__(cls)
+        Update.__init__(update, {})
+        update._load_record(record)
+        return update
+
 
 class Post(Update):
     """
     Base class of a Post, in any social source
     """
+    __slots__ = ()
     update_type = 'post'
 
     def _str(self):
@@ -97,11 +139,25 @@ class Media:
     """
     Base class of a Media, in any social source
     """
+    __slots__ = ('url', 'mtype', 'path')
+
     def __init__(self, url=None, mtype=None, path=None):
         self.url = url
         self.mtype = mtype
         self.path = path
 
+    def to_record(self):
+        return {
+            'class': f'{type(self).__module__}.{type(self).__qualname__}',
+            'url': self.url,
+            'mtype': self.mtype,
+            'path': self.path,
+        }
+
+    @staticmethod
+    def from_record(record):
+        return import_string(record['class'])(record['url'], record['mtype'], record['path'])
+
     def _str(self):
         return f"Media('{self.url}')"
 
@@ -116,28 +172,36 @@ class Image(Media):
     """
     Base class of an Image, in any social source
     """
+    __slots__ = ()
+
     def _str(self):
         return f"Image('{self.url}')"
 
-    def convert_to_ptb(self, caption=''):
+    def convert_to_ptb(self, caption='', media=None):
         """
-        Convert to python-telegram-bot object
+        Convert to python-telegram-bot object.
+        `media` replaces the URL: file_id, or path of the downloaded file
         """
-        return InputMediaPhoto(self.url, caption=caption, parse_mode='html')
+        from telegram import InputMediaPhoto
+        return InputMediaPhoto(media or self.url, caption=caption, parse_mode='html')
 
 
 class Video(Media):
     """
     Base class of a Video, in any social source
     """
+    __slots__ = ()
+
     def _str(self):
         return f"Video('{self.url}')"
 
-    def convert_to_ptb(self, caption=''):
+    def convert_to_ptb(self, caption='', media=None):
         """
-        Convert to python-telegram-bot object
+        Convert to python-telegram-bot object.
+        `media` replaces the URL: file_id, or path of the downloaded file
         """
-        return InputMediaVideo(self.url, caption=caption, parse_mode='html')
+        from telegram import InputMediaVideo
+        return InputMediaVideo(media or self.url, caption=caption, parse_mode='html')
 
 
 class Source:
@@ -150,52 +214,118 @@ class Source:
     def __init__(self, name, params):
         self.name = name
         self.params = params
+        self.feeds = []  # feeds using the source
 
-    def open(self, url):
+    def is_known(self, identifier):
+        """
+        Whether the update with the identifier is already
+        published by every feed that uses the source
         """
-        Load URL, and wait a bit for JS to load
+        return bool(self.feeds) and all(feed.is_published(identifier) for feed in self.feeds)
+
+    def commit(self, feed, checkpoint=None):
         """
-        ok = False
+        Called when the feed has published all the updates of the source.
+        The checkpoint is what the iteration the feed took its updates from returned
+        """
+
+    def fetch(self, url):
+        """
+        Load URL and return the page, keeping the politeness limits of its host
+        """
+        host = get_host(url)
+        if (cached := self.get_cached(url)) is not None:
+            metrics.inc('source_cache_hits', source=self.name, host=host)
+            return cached
+
         retry = 0
         while retry < self.RETRIES:
             try:
-                self.last_resp_text = self.http_get(url)
-                ok = True
-                break
+                with host_slot(url), metrics.timer('source_request', source=self.name, host=host):
+                    return self.http_get(url)
             except Exception as exc:
                 logger.error('Retrying because of error: %s', str(exc).strip())
+                metrics.inc('source_request_retries', source=self.name, host=host)
                 retry += 1
                 time.sleep(retry * 10)
 
-        if ok:
-            time.sleep(CONFIG.delay_after_any_request)
-        else:
-            raise ValueError('Retries limit reached')
+        metrics.inc('source_request_failures', source=self.name, host=host)
+        raise ValueError('Retries limit reached')
+
+    def ready_condition(self, url):
+        """
+        Return clients.Readiness the browser waits for after loading the URL, if any
+        """
+        return None
+
+    def get_cached(self, url):
+        """
+        Return the page if it's cached and fresh enough to skip the request
+        """
+        return None
+
+    def open(self, url):
+        """
+        Load URL to be the last response
+        """
+        self.last_resp_text = self.fetch(url)
+
+    def open_many(self, urls):
+        """
+        Load URLs concurrently. Yield (url, page or exception) in the order of the URLs.
+        Not more pages than the workers are loaded ahead of the consumer
+        """
+        def fetch(url):
+            try:
+                return self.fetch(url)
+            except Exception as exc:
+                return exc
+
+        workers = max(1, min(len(urls), CONFIG.http_pool_size))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch') as pool:
+            loading = deque()
+            for url in urls:
+                if len(loading) == workers:
+                    yield loading[0][0], loading.popleft()[1].result()
+                loading.append((url, pool.submit(fetch, url)))
+            while loading:
+                yield loading[0][0], loading.popleft()[1].result()
 
     def get_soup(self):
         """
         Return the souped DOM
         """
+        from bs4 import BeautifulSoup
         return BeautifulSoup(self.last_resp_text, 'html.parser')
 
     def get_updates(self):
         raise NotImplementedError
 
+    def iter_updates(self):
+        """
+        Yield the updates as they arrive. Sources able to stream override it,
+        and may return a checkpoint to be committed by the feeds taking the updates
+        """
+        yield from self.get_updates()
+
 
 class SeleniumSource(Source):
     """
     Mixin for any Source working with Selenium
     """
     def init_session(self):
-        self._client = get_browser()
+        self._client = get_browser_pool()
 
     def http_get(self, url):
         """
         Just simply get, without retries or smth
         """
         logger.info('selenium.get: %s', url)
-        self._client.get(url)
-        return self._client.page_source
+        with self._client.browser() as browser:
+            browser.get(url)
+            if condition := self.ready_condition(url):
+                browser.wait_ready(condition, CONFIG.page_ready_timeout)
+            return browser.page_source
 
 
 class RequestsSource(Source):
@@ -205,6 +335,10 @@ class RequestsSource(Source):
     def init_session(self):
         self._client = get_reqclient()
 
+    def get_cached(self, url):
+        if resp := self._client.get_fresh(url):
+            return resp.text
+
     def http_get(self, url, headers=None):
         """
         Just simply get, without retries or smth
@@ -221,7 +355,11 @@ class DummyPost(Post):
     """
     Fake Post for testing
     """
-    _text = f'Lorem ipsum {random.randint(1, 99999999999)}'
+    __slots__ = ()
+
+    def __init__(self, params):
+        super().__init__(params)
+        self._text = f'Lorem ipsum {random.randint(1, 99999999999)}'
 
 
 class DummySource(Source):
@@ -244,11 +382,23 @@ class Target:
     def _str(self):
         return f"Target('{self.name}')"
 
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
     def publish(self, update):
         raise NotImplementedError
 
     def schedule(self, update, date):
-        raise NotImplementedError
+        """
+        Publish the update at the date (datetime), through the outbox.
+        It's published by a feed having the target
+        """
+        if not (outbox := get_outbox()):
+            raise RuntimeError('Scheduling requires CONFIG.outbox')
+        outbox.enqueue(update, self, due_at=date.timestamp())
 
 
 class DummyTarget(Target):
@@ -266,25 +416,157 @@ class DummyTarget(Target):
         return True
 
 
+class Gathering:
+    """
+    Single pass over the updates of a source, shared by the feeds which take them.
+    The updates are kept, and whichever feed needs the next one first
+    takes it from the source, so the feeds go at their own pace
+    """
+    def __init__(self, source):
+        self.source = source
+        self.feeds = set()
+        # The source skips the updates known to its feeds, so the others must not reuse them
+        self.gathered_for = frozenset(source.feeds)
+        self.updates = []
+        self.exception = None
+        self.checkpoint = None
+        self.finished_at = None
+        self._iterator = None
+        self._started = None
+        self._lock = threading.Lock()
+
+    def is_reusable(self, feed, max_age=None):
+        """
+        Whether the feed may take these updates: it hasn't yet,
+        and they are still being gathered, or were gathered
+        within max_age seconds, if it's given
+        """
+        if feed in self.feeds or feed not in self.gathered_for:
+            return False
+        if self.finished_at is None:
+            return True
+        if self.exception is not None:
+            return False
+        return max_age is None or time.monotonic() - self.finished_at < max_age
+
+    def _pull(self):
+        """
+        Take the next update from the source
+        """
+        if self._iterator is None:
+            self._started = time.perf_counter()
+            self._iterator = self.source.iter_updates()
+        try:
+            self.updates.append(next(self._iterator))
+            return
+        except StopIteration as stop:
+            self.checkpoint = stop.value
+        except Exception as exc:
+            self.exception = exc
+
+        self.finished_at = time.monotonic()
+        metrics.observe('source_updates', time.perf_counter() - self._started, source=self.source.name)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self.updates):
+                yield self.updates[index]
+                index += 1
+                continue
+
+            with self._lock:
+                if index == len(self.updates):
+                    if self.finished_at is not None:
+                        break
+                    self._pull()
+
+        if self.exception is not None:
+            raise self.exception
+        return self.checkpoint
+
+
+class SourceRegistry:
+    """
+    Sources by name, each created once and shared by all the feeds listing it.
+    Updates of a source are gathered once per cycle and given to every feed
+    that uses it: the feeds asking while they are being gathered join in,
+    the feeds asking later get the same updates. With max_age, the updates
+    gathered longer ago than that many seconds are gathered again
+    """
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._sources = {}
+        self._gatherings = {}  # source name: the last Gathering
+        self._lock = threading.Lock()
+
+    def _str(self):
+        return f'SourceRegistry({list(self._sources)})'
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+    def subscribe(self, name, feed):
+        """
+        Return the source, creating if necessarry, and add the feed to its users
+        """
+        with self._lock:
+            if name not in self._sources:
+                src = CONFIG.sources[name]
+                self._sources[name] = import_string(src['class'])(name, src)
+            source = self._sources[name]
+            source.feeds.append(feed)
+        return source
+
+    def unsubscribe(self, feed):
+        with self._lock:
+            for source in self._sources.values():
+                if feed in source.feeds:
+                    source.feeds.remove(feed)
+
+    def iter_updates(self, source, feed):
+        """
+        Return iterator over the updates of the source for the feed,
+        gathering them only if there are no shared ones the feed may take.
+        The iterator returns the checkpoint of the gathering
+        """
+        with self._lock:
+            gathering = self._gatherings.get(source.name)
+            is_new = gathering is None or not gathering.is_reusable(feed, self.max_age)
+            if is_new:
+                gathering = self._gatherings[source.name] = Gathering(source)
+            gathering.feeds.add(feed)
+
+        if not is_new:
+            logger.info('%s takes the updates of %s gathered for another feed', feed, source.name)
+            metrics.inc('source_updates_shared', source=source.name, feed=feed.name)
+        return iter(gathering)
+
+
 class Feed:
     """
-    Feed is [sources] -> [targets] system
+    Feed is [sources] -> [targets] system.
+    Feeds given the same registry share their sources
     """
     _storage = None
+    _published = None
+    failed_sources = frozenset()
+    checkpoints = {}
 
-    def __init__(self, name, params):
+    def __init__(self, name, params, registry=None):
         """
         Initialize sources and targets of the feed
         """
         self.name = name
         self.params = params
+        self.registry = registry or SourceRegistry()
+        self._storage_lock = threading.Lock()
         logger.info('Processing %s: %s > %s', self, params['sources'], params['targets'])
 
-        self.sources = []
-        for name in params['sources']:
-            src = CONFIG.sources[name]
-            source = import_string(src['class'])(name, src)
-            self.sources.append(source)
+        self.sources = [self.registry.subscribe(name, self) for name in params['sources']]
 
         self.targets = []
         for name in params['targets']:
@@ -303,43 +585,221 @@ class Feed:
 
     @property
     def storage(self):
-        if self._storage is None:
-            self._storage = import_string(self.params['storage']['class'])(self.params['storage'])
+        """
+        Return the feed's storage, creating if necessarry.
+        The gatherings of the other feeds reach it too, from their threads
+        """
+        with self._storage_lock:
+            if self._storage is None:
+                self._storage = import_string(self.params['storage']['class'])(self.params['storage'])
         return self._storage
 
+    def load_published(self):
+        """
+        Load identifiers published in each target, a query per target.
+        Updates waiting in the outbox count too, so they are not gathered again.
+        The result is set at once, the other feeds' gatherings never see it partial
+        """
+        outbox = get_outbox()
+        published = {}
+        for target in self.targets:
+            ids = self.storage.load_published(self, target)
+            if outbox:
+                ids |= outbox.queued_ids(self, target)
+            published[target.name] = ids
+        self._published = published
+        return published
+
+    def is_published(self, identifier):
+        """
+        Whether the update is published in all the feed's targets
+        """
+        published = self._published if self._published is not None else self.load_published()
+        return all(identifier in ids for ids in published.values())
+
+    def iter_updates(self):
+        """
+        Yield the updates of all the feed's sources as they arrive.
+        Sources failed meanwhile are put in failed_sources,
+        checkpoints of the others are kept for committing.
+        The gathering is timed till the last update, publishing of the taken ones included
+        """
+        self.failed_sources = set()
+        self.checkpoints = {}
+        with metrics.timer('feed_gather', feed=self.name):
+            for src in self.sources:
+                updates = self.registry.iter_updates(src, self)
+                try:
+                    while True:
+                        try:
+                            update = next(updates)
+                        except StopIteration as stop:
+                            self.checkpoints[src] = stop.value
+                            break
+                        metrics.inc('updates_gathered', feed=self.name)
+                        yield update
+                except Exception as exc:
+                    logger.exception(exc)
+                    self.failed_sources.add(src)
+
     def gather(self):
         """
         Gather all updates from all the feed's sources
         """
-        updates = []
-        for src in self.sources:
+        self.load_published()
+        return list(self.iter_updates())
+
+    def _publish_update(self, target, update, published_ids, result):
+        """
+        Publish the update to the target, and remember it right away.
+        Return the error if not published
+        """
+        try:
+            error = None if target.publish(update) else 'not published'
+        except Exception as exc:
+            logger.exception(exc)
+            error = exc
+
+        if error is None:
+            logger.info('Remember: %s published in %s', update, target)
+            metrics.inc('updates_published', feed=self.name, target=target.name)
+            self.storage.remember_published(update, self, target)
+            published_ids.add(update.identifier)
+            result['published'].append(update)
+        else:
+            logger.error('Error, %s not published in %s', update, target)
+            metrics.inc('updates_failed', feed=self.name, target=target.name)
+            result['failed'].append(update)
+        return error
+
+    def _publish_to(self, target, updates, published_ids):
+        """
+        Publish the updates to the target one by one, keeping their order.
+        With the outbox, the updates are queued there and the due ones are published
+        """
+        if outbox := get_outbox():
+            return self._publish_via_outbox(outbox, target, updates, published_ids)
+
+        result = {'published': [], 'failed': []}
+        for update in updates:
+            if update.identifier in published_ids:
+                logger.info('%s for %s already published in %s', update, self, target)
+                continue
+            self._publish_update(target, update, published_ids, result)
+
+        return result
+
+    def _publish_via_outbox(self, outbox, target, updates, published_ids):
+        result = {'published': [], 'failed': []}
+        self._publish_due(outbox, target, published_ids, result)
+
+        for update in updates:
+            if update.identifier in published_ids:
+                logger.info('%s for %s already published or queued in %s', update, self, target)
+                continue
+            outbox.enqueue(update, target, self)
+            published_ids.add(update.identifier)
+            self._publish_due(outbox, target, published_ids, result)
+
+        return result
+
+    def _publish_due(self, outbox, target, published_ids, result):
+        """
+        Publish the outbox items due for the target, retrying the failed ones later
+        """
+        for item in outbox.claim_due(target, self):
             try:
-                updates.extend(src.get_updates())
+                update = Update.from_record(item.payload)
             except Exception as exc:
                 logger.exception(exc)
+                outbox.mark_failed(item, exc)
+                continue
 
-        return updates
+            if (error := self._publish_update(target, update, published_ids, result)) is None:
+                outbox.mark_sent(item)
+            else:
+                outbox.mark_failed(item, error)
 
-    def publish(self, updates):
+    def drain_outbox(self):
         """
-        Publish all the gathered updates to all the feed's targets
+        Publish the outbox items which became due, without gathering
         """
+        if not (outbox := get_outbox()):
+            return
+        published = self._published if self._published is not None else self.load_published()
         for target in self.targets:
-            for update in updates:
+            result = {'published': [], 'failed': []}
+            self._publish_due(outbox, target, published[target.name], result)
+
+    @staticmethod
+    def _drain(updates_queue):
+        while (update := updates_queue.get()) is not None:
+            yield update
+
+    @staticmethod
+    def _offer(updates_queue, worker, update):
+        """
+        Put the update in the target's queue, unless the target's worker is dead
+        """
+        while not worker.done():
+            try:
+                updates_queue.put(update, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def publish(self, updates):
+        """
+        Publish the updates to all the feed's targets as they come,
+        a worker per target, so a slow target doesn't hold the others.
+        `updates` may be a generator, each target gets them through
+        a bounded queue, so a slow target holds the gathering back instead
+        of piling the updates up.
+        Return {target name: {'published': [...], 'failed': [...]}}
+        """
+        published = self._published if self._published is not None else self.load_published()
+        queues = {target: queue.Queue(CONFIG.publish_queue_size) for target in self.targets}
+
+        workers = max(1, len(self.targets))
+        with metrics.timer('feed_publish', feed=self.name):
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='publish') as pool:
+                futures = {
+                    target: pool.submit(
+                        self._publish_to, target, self._drain(queues[target]), published[target.name])
+                    for target in self.targets
+                }
+                try:
+                    for update in updates:
+                        for target, updates_queue in queues.items():
+                            self._offer(updates_queue, futures[target], update)
+                finally:
+                    for target, updates_queue in queues.items():
+                        self._offer(updates_queue, futures[target], None)
+
+        return {target.name: future.result() for target, future in futures.items()}
+
+    def process(self):
+        """
+        Publish the updates while they are being gathered
+        """
+        self.load_published()
+        results = self.publish(self.iter_updates())
 
-                if self.storage.find_published(update, self):
-                    logger.info('%s for %s already published', update, self)
-                    continue
+        # The outbox keeps the failed updates, the sources needn't give them again
+        if get_outbox() or not any(result['failed'] for result in results.values()):
+            for src in self.sources:
+                if src not in self.failed_sources:
+                    src.commit(self, self.checkpoints.get(src))
 
-                if published := target.publish(update):
-                    logger.info('Remember: %s published in %s', update, self)
-                    self.storage.remember_published(update, self)
-                else:
-                    logger.error('Error, %s not published in %s', update, target)
+    def close(self):
+        self.registry.unsubscribe(self)
+        if self._storage is not None:
+            self._storage.close()
 
 
 def cleanup():
     """
     Various cleanups at the end of the job
     """
-    destroy_browser()
+    destroy_browser_pool()
+    run_cleanups()
@@ -0,0 +1,277 @@
+import re
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import CONFIG
+from .utils import get_logger, on_cleanup
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+logger = get_logger()
+SHORT_CODE_RE = re.compile(r'''let short_code\s*=\s*["']([^"']*)["']''')
+
+
+def extract_short_code(html):
+    """
+    Get the Instagram short code right from the raw page
+    """
+    if match := SHORT_CODE_RE.search(html):
+        return match.group(1)
+    return ''
+
+
+def _has_class(name):
+    """
+    XPath condition equal to the ".name" CSS selector
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class Extractor:
+    """
+    Base for any engine extracting data from Gramhir pages
+    """
+    name = None
+
+    def extract_post(self, html):
+        """
+        Return dict of all the post fields, extracted from the raw post page
+        """
+        raise NotImplementedError
+
+    def extract_post_urls(self, html):
+        """
+        Return post URLs from the raw profile page, in the page order
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _post(html, text, author, image_urls, video_urls):
+        return {
+            'short_code': extract_short_code(html),
+            'text': (text or '').strip(),
+            'author': (author or '').strip(),
+            'image_urls': image_urls,
+            'video_urls': video_urls,
+        }
+
+
+class SoupExtractor(Extractor):
+    """
+    Pure Python BeautifulSoup engine, always available
+    """
+    name = 'soup'
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        self._bs = BeautifulSoup
+
+    def _soup(self, html):
+        return self._bs(html, 'html.parser')
+
+    def extract_post(self, html):
+        soup = self._soup(html)
+        descr = soup.select_one('div.single-photo-description')
+        nick = soup.select_one('div.single-photo-nickname')
+
+        image_urls, video_urls = [], []
+        if carousel := soup.select_one('div.owl-carousel'):
+            for item in carousel.select('div.item'):
+                if (img := item.find('img')) and img.get('src'):
+                    image_urls.append(img['src'])
+                if (vid := item.find('video')) and vid.get('src'):
+                    video_urls.append(vid['src'])
+        elif single := soup.select_one('div.single-photo'):
+            if vid := single.find('video'):
+                if vid.get('src'):
+                    video_urls.append(vid['src'])
+            elif (img := single.find('img')) and img.get('src'):
+                image_urls.append(img['src'])
+
+        return self._post(html, descr and descr.text, nick and nick.text, image_urls, video_urls)
+
+    def extract_post_urls(self, html):
+        urls = []
+        for div in self._soup(html).select('div.photo'):
+            if (a := div.find('a')) and (href := a.get('href')):
+                urls.append(href)
+        return urls
+
+
+class LxmlExtractor(Extractor):
+    """
+    libxml2 engine: the page is parsed once in C, fields are taken by XPath
+    """
+    name = 'lxml'
+
+    XPATHS = {
+        'descr': f'//div[{_has_class("single-photo-description")}]',
+        'nick': f'//div[{_has_class("single-photo-nickname")}]',
+        'carousel': f'//div[{_has_class("owl-carousel")}]',
+        'item': f'.//div[{_has_class("item")}]',
+        'single': f'//div[{_has_class("single-photo")}]',
+        'photo_href': f'//div[{_has_class("photo")}]/descendant::a[1]/@href',
+    }
+
+    def __init__(self):
+        import lxml.html
+        from lxml import etree
+        self._fromstring = lxml.html.fromstring
+        self._xp = {key: etree.XPath(path) for key, path in self.XPATHS.items()}
+
+    @staticmethod
+    def _first(elements):
+        return elements[0] if elements else None
+
+    @staticmethod
+    def _src(elem, tag):
+        found = elem.xpath(f'.//{tag}[1]/@src')
+        return found[0] if found and found[0] else None
+
+    def extract_post(self, html):
+        tree = self._fromstring(html)
+        descr = self._first(self._xp['descr'](tree))
+        nick = self._first(self._xp['nick'](tree))
+
+        image_urls, video_urls = [], []
+        if (carousel := self._first(self._xp['carousel'](tree))) is not None:
+            for item in self._xp['item'](carousel):
+                if img := self._src(item, 'img'):
+                    image_urls.append(img)
+                if vid := self._src(item, 'video'):
+                    video_urls.append(vid)
+        elif (single := self._first(self._xp['single'](tree))) is not None:
+            if single.xpath('.//video'):
+                if vid := self._src(single, 'video'):
+                    video_urls.append(vid)
+            elif img := self._src(single, 'img'):
+                image_urls.append(img)
+
+        return self._post(
+            html,
+            descr.text_content() if descr is not None else None,
+            nick.text_content() if nick is not None else None,
+            image_urls,
+            video_urls,
+        )
+
+    def extract_post_urls(self, html):
+        return [str(href) for href in self._xp['photo_href'](self._fromstring(html)) if href]
+
+
+class SelectolaxExtractor(Extractor):
+    """
+    Lexbor engine of selectolax, the fastest one
+    """
+    name = 'selectolax'
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self._parser = LexborHTMLParser
+
+    @staticmethod
+    def _src(elem, tag):
+        if found := elem.css_first(tag):
+            return found.attributes.get('src') or None
+
+    def extract_post(self, html):
+        tree = self._parser(html)
+        descr = tree.css_first('div.single-photo-description')
+        nick = tree.css_first('div.single-photo-nickname')
+
+        image_urls, video_urls = [], []
+        if carousel := tree.css_first('div.owl-carousel'):
+            for item in carousel.css('div.item'):
+                if img := self._src(item, 'img'):
+                    image_urls.append(img)
+                if vid := self._src(item, 'video'):
+                    video_urls.append(vid)
+        elif single := tree.css_first('div.single-photo'):
+            if single.css_first('video'):
+                if vid := self._src(single, 'video'):
+                    video_urls.append(vid)
+            elif img := self._src(single, 'img'):
+                image_urls.append(img)
+
+        return self._post(
+            html,
+            descr.text(deep=True) if descr else None,
+            nick.text(deep=True) if nick else None,
+            image_urls,
+            video_urls,
+        )
+
+    def extract_post_urls(self, html):
+        urls = []
+        for div in self._parser(html).css('div.photo'):
+            if (a := div.css_first('a')) and (href := a.attributes.get('href')):
+                urls.append(href)
+        return urls
+
+
+EXTRACTORS = {
+    cls.name: cls for cls in (SelectolaxExtractor, LxmlExtractor, SoupExtractor)
+}
+_extractors = {}
+
+
+def get_extractor(name=None):
+    """
+    Return extractor by the name, or by CONFIG.html_extractor.
+    "auto" means the fastest installed engine
+    """
+    name = name or CONFIG.html_extractor
+    if name not in _extractors:
+        if name == 'auto':
+            for cls in EXTRACTORS.values():
+                try:
+                    _extractors[name] = cls()
+                    break
+                except ImportError:
+                    continue
+        else:
+            _extractors[name] = EXTRACTORS[name]()
+    return _extractors[name]
+
+
+def parse_post_page(html, engine):
+    """
+    Extract the post fields from the raw page, in a parse worker process.
+    Return the fields and the seconds it took
+    """
+    extractor = get_extractor(engine)
+    started = time.perf_counter()
+    fields = extractor.extract_post(html)
+    return fields, time.perf_counter() - started
+
+
+def _init_parse_worker():
+    # Ctrl+C reaches the whole process group, the main process handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_parse_pool():
+    """
+    Return pool of the parse worker processes if configured, creating if necessarry
+    """
+    global _parse_pool
+    if not CONFIG.parse_processes:
+        return None
+
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            logger.info('Starting %s parse processes', CONFIG.parse_processes)
+            _parse_pool = ProcessPoolExecutor(CONFIG.parse_processes, initializer=_init_parse_worker)
+    return _parse_pool
+
+
+@on_cleanup
+def destroy_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(cancel_futures=True)
+            _parse_pool = None
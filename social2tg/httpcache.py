@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+
+class CachedResponse:
+    """
+    Response served from the cache, having the attributes the sources use
+    """
+    def __init__(self, url, status_code, text, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def _str(self):
+        return f"CachedResponse('{self.url}')"
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+
+class HttpCache:
+    """
+    On-disk cache of response bodies, keyed by URL.
+    Params:
+    - "path": directory of the cache
+    - "max_size": bytes, the least recently used entries are evicted when exceeded
+    - "freshness": {URL regex: seconds}, how long an entry is served without
+      asking the server; the first matching regex is used, 0 by default
+    """
+    def __init__(self, params):
+        self.path = Path(params['path'])
+        self.max_size = params.get('max_size')
+        self.freshness = [(re.compile(regex), secs) for regex, secs in params.get('freshness', {}).items()]
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}
+        for meta_path in self.path.glob('*.json'):
+            try:
+                meta = json.loads(meta_path.read_text())
+            except (OSError, ValueError):
+                continue
+            self._index[meta_path.stem] = meta
+
+    def __str__(self):
+        return f'HttpCache({self.path})'
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _body_path(self, key):
+        return self.path / f'{key}.body'
+
+    def _meta_path(self, key):
+        return self.path / f'{key}.json'
+
+    def _write_meta(self, key, meta):
+        self._meta_path(key).write_text(json.dumps(meta))
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        for path in (self._body_path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def freshness_for(self, url):
+        for regex, secs in self.freshness:
+            if regex.search(url):
+                return secs
+        return 0
+
+    def lookup(self, url):
+        """
+        Return metadata of the cached response of the URL, if any
+        """
+        with self._lock:
+            return self._index.get(self._key(url))
+
+    def is_fresh(self, meta):
+        return time.time() - meta['stored_at'] < self.freshness_for(meta['url'])
+
+    @staticmethod
+    def validators(meta):
+        """
+        Return headers of the conditional request for the cached response
+        """
+        headers = {}
+        if etag := meta.get('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := meta.get('last_modified'):
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def load(self, meta, revalidated=False):
+        """
+        Return the cached response, marking it as recently used
+        """
+        key = self._key(meta['url'])
+        try:
+            text = self._body_path(key).read_text(encoding='utf-8')
+        except FileNotFoundError:
+            with self._lock:
+                self._remove(key)
+            return None
+
+        with self._lock:
+            meta['used_at'] = time.time()
+            if revalidated:
+                meta['stored_at'] = meta['used_at']
+            self._write_meta(key, meta)
+
+        return CachedResponse(meta['url'], 200, text, {'X-Cache': 'HIT'})
+
+    def store(self, url, resp):
+        """
+        Cache successful response
+        """
+        if resp.status_code != 200:
+            return
+
+        key = self._key(url)
+        body = resp.text.encode('utf-8')
+        now = time.time()
+        meta = {
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'stored_at': now,
+            'used_at': now,
+            'size': len(body),
+        }
+        with self._lock:
+            self._body_path(key).write_bytes(body)
+            self._write_meta(key, meta)
+            self._index[key] = meta
+            self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+
+        total = sum(meta['size'] for meta in self._index.values())
+        for key, meta in sorted(self._index.items(), key=lambda item: item[1]['used_at']):
+            if total <= self.max_size:
+                break
+            total -= meta['size']
+            self._remove(key)
@@ -1,12 +1,16 @@
-import instaloader
-import time
+from collections import deque
 
 import CONFIG
+from . import metrics
+from .clients import ElementsPresent, SourceContains, get_proxy
 from .common import Image, Post, RequestsSource, SeleniumSource, Source, Video
-from .utils import find_elem, get_logger, ip_in_string
+from .extract import get_extractor, get_parse_pool, parse_post_page
+from .ratelimit import acquire
+from .utils import get_logger, ip_in_string, media_id_to_shortcode
 
 
 logger = get_logger()
+INSTAGRAM_URL = 'https://www.instagram.com/'
 
 
 class InstagramSource(Source):
@@ -22,6 +26,18 @@ class InstagramSource(Source):
 
 
 class InstagramPost(Post):
+    __slots__ = ('orig_post_id',)
+
+    @property
+    def identifier(self):
+        return self.orig_post_id
+
+    def _load_record(self, record):
+        super()._load_record(record)
+        self.orig_post_id = record['orig_post_id']
+
+    def to_record(self):
+        return {**super().to_record(), 'orig_post_id': self.orig_post_id}
 
     def construct_footer(self):
         footer = (
@@ -33,90 +49,27 @@ class InstagramPost(Post):
 
 class GramhirPost(InstagramPost):
     """
-    Post handler for Gramhir source
+    Post handler for Gramhir source.
+    All the fields are extracted from the raw page at once,
+    or given already extracted, as "fields".
+    The page itself is not kept
     """
+    __slots__ = ()
+
     def __init__(self, params):
-        super().__init__(params)
+        super().__init__({'url': params['url']})
         self._url = params['url']
-        self._soup = params['soup']
-        self.orig_post_id = self._extract_orig_post_id()
-        self.orig_url = f'https://www.instagram.com/p/{self.orig_post_id}/'
-
-    @property
-    def identifier(self):
-        return self.orig_post_id
-
-    def _extract_orig_post_id(self):
-        raw = str(self._soup)
-        idx1 = raw.find('let short_code = ')
-        cut1 = raw[idx1:]
-        idx2 = cut1.find('"')
-        cut2 = cut1[idx2+1:]
-        idx3 = cut2.find('"')
-        post_id = cut2[:idx3]
-        return post_id
-
-    @property
-    def text(self):
-        if self._text is None:
-            if descrs := self._soup.select('div.single-photo-description'):
-                self._text = (descrs[0].text or '').strip()
-        return self._text or ''
-
-    @property
-    def author(self):
-        if self._author is None:
-            if nicks := self._soup.select('div.single-photo-nickname'):
-                self._author = (nicks[0].text or '').strip()
-        return self._author or ''
-
-    @property
-    def media(self):
-        """
-        Gather post images and videos in one list
-        """
-        if self._media is None:
-            self._media = []
-            self._media.extend([Image(url=url) for url in self._get_image_urls()])
-            self._media.extend([Video(url=url) for url in self._get_video_urls()])
-        return self._media
-
-    def _find_img(self, soup):
-        return find_elem(soup, 'img')
 
-    def _find_vid(self, soup):
-        return find_elem(soup, 'video')
-
-    def _get_image_urls(self):
-        img_urls = []
-
-        if carousel := find_elem(self._soup, 'div.owl-carousel'):
-            for item in carousel.select('div.item'):
-                if img := self._find_img(item):
-                    img_urls.append(img.attrs['src'])
-        else:
-            if single := find_elem(self._soup, 'div.single-photo'):
-                if not self._find_vid(single):
-                    img = self._find_img(single)
-                    img_urls.append(img.attrs['src'])
-
-        return img_urls
-
-    def _get_video_urls(self):
-        vid_urls = []
-
-        if carousel := find_elem(self._soup, 'div.owl-carousel'):
-            for item in carousel.select('div.item'):
-                if vid := self._find_vid(item):
-                    if url := vid.attrs.get('src'):
-                        vid_urls.append(url)
-        else:
-            if single := find_elem(self._soup, 'div.single-photo'):
-                if vid := self._find_vid(single):
-                    if url := vid.attrs.get('src'):
-                        vid_urls.append(url)
-
-        return vid_urls
+        if (fields := params.get('fields')) is None:
+            extractor = get_extractor()
+            with metrics.timer('post_parse', engine=extractor.name):
+                fields = extractor.extract_post(params['html'])
+        self.orig_post_id = fields['short_code']
+        self.orig_url = f'https://www.instagram.com/p/{self.orig_post_id}/'
+        self._text = fields['text']
+        self._author = fields['author']
+        self._media = [Image(url=url) for url in fields['image_urls']]
+        self._media.extend([Video(url=url) for url in fields['video_urls']])
 
 
 class GramhirSource(InstagramSource):
@@ -140,33 +93,76 @@ class GramhirSource(InstagramSource):
         return url
 
     def open_profile(self):
-        try:
-            self.open(self.url)
-            for i in range(3):
-                self._client.scroll_up_down()
-        except Exception as exc:
-            logger.error('Cant open profile: %s', exc)
+        """
+        Load the profile page. The error is raised, so the gathering fails
+        instead of parsing the page of the previous check
+        """
+        self.open(self.url)
+
+    def ready_condition(self, url):
+        if url == self.url:
+            return ElementsPresent('div.photo', CONFIG.gramhir_profile_ready_posts)
+        return SourceContains('let short_code')
 
     def get_last_posts(self):
         """
         Get list of Post instances of posts
         which appeared after the last check
         """
-        posts = []
+        return list(self.iter_last_posts())
+
+    def iter_last_posts(self):
+        """
+        Yield Post instances of posts which appeared after the last check,
+        each one as soon as its page is loaded and parsed
+        """
         urls = self._parse_post_urls()
         if not urls:
             logger.info('Something went wrong, no last posts found on the page')
 
+        new_urls = []
         for url in urls:
-            try:
-                self.open(url)
-            except Exception as exc:
-                logger.info('Skipping post %s because of error: %s', url, exc)
+            if self.is_known(self._short_code_from_url(url)):
+                logger.info('Skipping post %s because it is already published', url)
+            else:
+                new_urls.append(url)
+
+        if pool := get_parse_pool():
+            yield from self._parse_posts_in_pool(pool, new_urls)
+            return
+
+        for url, page in self.open_many(new_urls):
+            if isinstance(page, Exception):
+                logger.info('Skipping post %s because of error: %s', url, page)
             else:
-                posts.append(GramhirPost({'url': url, 'soup': self.get_soup()}))
-            time.sleep(CONFIG.delay_after_post)
+                yield GramhirPost({'url': url, 'html': page})
 
-        return posts
+    def _parse_posts_in_pool(self, pool, urls):
+        """
+        Send each page to the parse processes as soon as it's loaded,
+        so the pages are parsed while the others are still loading
+        """
+        engine = get_extractor().name
+        parsing = deque()
+        for url, page in self.open_many(urls):
+            if isinstance(page, Exception):
+                logger.info('Skipping post %s because of error: %s', url, page)
+                continue
+            parsing.append((url, pool.submit(parse_post_page, page, engine)))
+            while parsing and parsing[0][1].done():
+                yield from self._parsed_post(engine, *parsing.popleft())
+
+        while parsing:
+            yield from self._parsed_post(engine, *parsing.popleft())
+
+    def _parsed_post(self, engine, url, future):
+        try:
+            fields, seconds = future.result()
+        except Exception as exc:
+            logger.error('Skipping post %s, cant parse it: %s', url, exc)
+            return
+        metrics.observe('post_parse', seconds, engine=engine)
+        yield GramhirPost({'url': url, 'fields': fields})
 
     def get_last_stories(self):
         stories = []
@@ -178,30 +174,34 @@ class GramhirSource(InstagramSource):
         Get list of Update instances of update
         which appeared after the last check
         """
-        updates = []
-        self.open_profile()
+        return list(self.iter_updates())
 
-        updates += self.get_last_posts()
-        updates += self.get_last_stories()
-        return updates
+    def iter_updates(self):
+        self.open_profile()
+        yield from self.iter_last_posts()
+        yield from self.get_last_stories()
 
     def _parse_post_urls(self):
         """
         Get post URLs from the provided profile soup
         """
-        soup = self.get_soup()
-
-        urls = []
-        for div in soup.select('div.photo'):
-            if as_ := div.select('a'):
-                if href := as_[0].attrs.get('href'):
-                    urls.append(href)
+        urls = get_extractor().extract_post_urls(self.last_resp_text)
 
         if ip_in_string(CONFIG.gramhir_host):
             urls = [u.replace(CONFIG.gramhir_host_header, CONFIG.gramhir_host) for u in urls]
 
         return urls[::-1]
 
+    def _short_code_from_url(self, url):
+        """
+        Get Instagram short code of the post from its URL on the profile page.
+        Mirrors use either the short code itself or the numeric media ID
+        """
+        last = url.rstrip('/').rsplit('/', 1)[-1].split('?')[0]
+        if last.split('_')[0].isdigit():
+            return media_id_to_shortcode(last)
+        return last
+
 
 class GramhirSeleniumSource(GramhirSource, SeleniumSource):
     pass
@@ -223,26 +223,65 @@ class InstaloaderSource(InstagramSource):
     Instagram client that uses instaloader lib
     """
     def __init__(self, name, params):
+        import instaloader
         super().__init__(name, params)
         self.nickname = params['id']
         self._il = instaloader.Instaloader()
+        if proxy := get_proxy():
+            # Instaloader takes no proxy, its anonymous session is kept for the whole run
+            self._il.context._session.proxies.update({'http': proxy, 'https': proxy})
 
     def open_profile(self):
+        import instaloader
+        acquire(INSTAGRAM_URL)
         return instaloader.Profile.from_username(self._il.context, self.nickname)
 
+    def get_watermark(self):
+        """
+        Return (shortcode, date) of the newest post all the feeds are done with.
+        None if any feed has no watermark yet
+        """
+        watermarks = [feed.storage.get_watermark(self, feed) for feed in self.feeds]
+        if watermarks and all(watermarks):
+            return min(watermarks, key=lambda watermark: watermark[1])
+
     def get_last_posts(self):
         """
         Get list of Post instances of posts
         which appeared after the last check
         """
-        posts = []
+        return list(self.iter_last_posts())
+
+    def iter_last_posts(self):
+        """
+        Yield Post instances of posts which appeared after the last check:
+        the iteration stops at the watermark, skipping the pinned posts.
+        Return (shortcode, date) of the newest post seen, the next watermark
+        """
+        watermark = self.get_watermark()
+        newest = None
+
         for idx, ilpost in enumerate(self._profile.get_posts()):
-            posts.append(InstaloaderPost(ilpost))
-            if idx > 10:
+            if idx > 11:
                 break
-            time.sleep(CONFIG.delay_after_post)
 
-        return posts
+            if not getattr(ilpost, 'is_pinned', False):
+                if watermark and (ilpost.shortcode == watermark[0] or ilpost.date_utc <= watermark[1]):
+                    logger.info('%s: reached the watermark at %s', self.name, ilpost.shortcode)
+                    break
+                if newest is None:
+                    newest = (ilpost.shortcode, ilpost.date_utc)
+
+            if self.is_known(ilpost.shortcode):
+                continue
+            yield InstaloaderPost(ilpost)
+            acquire(INSTAGRAM_URL)
+
+        return newest
+
+    def commit(self, feed, checkpoint=None):
+        if checkpoint:
+            feed.storage.set_watermark(self, feed, *checkpoint)
 
     def get_last_stories(self):
         stories = []
@@ -254,19 +293,23 @@ class InstaloaderSource(InstagramSource):
         Get list of Update instances of update
         which appeared after the last check
         """
-        updates = []
-        self._profile = self.open_profile()
+        return list(self.iter_updates())
 
-        updates += self.get_last_posts()
-        updates += self.get_last_stories()
-        return updates
+    def iter_updates(self):
+        self._profile = self.open_profile()
+        newest = yield from self.iter_last_posts()
+        yield from self.get_last_stories()
+        return newest
 
 
 class InstaloaderPost(InstagramPost):
     """
     Post handler for Instaloader source
     """
+    __slots__ = ('_ilpost',)
+
     def __init__(self, ilpost):
+        super().__init__({})
         self._author = f'@{ilpost.owner_username}'
         self._date = ilpost.date_utc
         self._text = ilpost.caption
@@ -275,10 +318,6 @@ class InstaloaderPost(InstagramPost):
 
         self.orig_post_id = ilpost.shortcode
 
-    @property
-    def identifier(self):
-        return self.orig_post_id
-
     @property
     def media(self):
         """
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import CONFIG
+from .constants import HEADERS_LIKE_BROWSER
+from .ratelimit import host_slot
+from .utils import get_logger, on_cleanup
+
+
+_media_cache = None
+_media_cache_lock = threading.Lock()
+logger = get_logger()
+
+
+class MediaCache:
+    """
+    Local content-addressed cache of the downloaded media,
+    and Telegram file_ids the media were uploaded as.
+    Telegram file_ids are valid only for the bot which uploaded the file,
+    so they are kept per bot.
+    Params: "path" directory, "max_size" of the files in bytes,
+    the least recently used files are evicted when exceeded
+    """
+    CHUNK = 2 ** 16
+    KEEP_RECENT = 60 * 60  # seconds
+
+    def __init__(self, params):
+        self.path = Path(params['path'])
+        self.max_size = params.get('max_size')
+        self.files_path = self.path / 'files'
+        self.files_path.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path / 'media.sqlite', timeout=30, check_same_thread=False)
+        with self.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('CREATE TABLE IF NOT EXISTS urls (url text PRIMARY KEY, sha256 text)')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS files (sha256 text PRIMARY KEY, size integer, used_at real)')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS file_ids '
+                '(bot text, sha256 text, file_id text, PRIMARY KEY (bot, sha256))')
+
+    def __str__(self):
+        return f'MediaCache({self.path})'
+
+    @contextmanager
+    def cursor(self):
+        with self._lock:
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def url_key(url):
+        """
+        CDN URLs of the same media differ in the signing query and the edge host
+        """
+        return urlsplit(url).path or url
+
+    def _file_path(self, sha256):
+        return self.files_path / sha256
+
+    def _sha256(self, url):
+        with self.cursor() as cursor:
+            row = cursor.execute('SELECT sha256 FROM urls WHERE url = ?', (self.url_key(url),)).fetchone()
+        return row[0] if row else None
+
+    def get_file_id(self, bot, url):
+        """
+        Return file_id the media was uploaded as by the bot, if any
+        """
+        sql = (
+            'SELECT file_ids.file_id FROM urls JOIN file_ids ON urls.sha256 = file_ids.sha256 '
+            'WHERE urls.url = ? AND file_ids.bot = ?'
+        )
+        with self.cursor() as cursor:
+            row = cursor.execute(sql, (self.url_key(url), bot)).fetchone()
+        return row[0] if row else None
+
+    def remember_file_id(self, bot, url, file_id):
+        if sha256 := self._sha256(url):
+            sql = 'INSERT OR REPLACE INTO file_ids (bot, sha256, file_id) VALUES (?, ?, ?)'
+            with self.cursor() as cursor:
+                cursor.execute(sql, (bot, sha256, file_id))
+
+    def download(self, url):
+        """
+        Return path of the media file, downloading it if not cached yet
+        """
+        import requests
+
+        if (sha256 := self._sha256(url)) and self._file_path(sha256).exists():
+            with self.cursor() as cursor:
+                cursor.execute('UPDATE files SET used_at = ? WHERE sha256 = ?', (time.time(), sha256))
+            return self._file_path(sha256)
+
+        logger.info('Downloading media: %s', url)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.files_path, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp, host_slot(url):
+                resp = requests.get(url, headers=HEADERS_LIKE_BROWSER, stream=True, timeout=60)
+                resp.raise_for_status()
+                for chunk in resp.iter_content(self.CHUNK):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            sha256 = digest.hexdigest()
+            os.replace(tmp_path, self._file_path(sha256))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        with self.cursor() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO urls (url, sha256) VALUES (?, ?)', (self.url_key(url), sha256))
+            cursor.execute(
+                'INSERT OR REPLACE INTO files (sha256, size, used_at) VALUES (?, ?, ?)',
+                (sha256, size, time.time()))
+        self._evict()
+        return self._file_path(sha256)
+
+    def _evict(self):
+        """
+        Remove the least recently used files above max_size.
+        Files used recently are kept, they may be being published right now.
+        Their file_ids stay, Telegram keeps the files
+        """
+        if self.max_size is None:
+            return
+        used_before = time.time() - self.KEEP_RECENT
+
+        with self.cursor() as cursor:
+            total = cursor.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+            if total <= self.max_size:
+                return
+
+            sql = 'SELECT sha256, size FROM files WHERE used_at < ? ORDER BY used_at'
+            rows = cursor.execute(sql, (used_before,)).fetchall()
+            for sha256, size in rows:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(self._file_path(sha256))
+                except FileNotFoundError:
+                    pass
+                cursor.execute('DELETE FROM files WHERE sha256 = ?', (sha256,))
+                total -= size
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_media_cache():
+    """
+    Return the media cache if configured, creating if necessarry
+    """
+    global _media_cache
+    if not CONFIG.media_cache:
+        return None
+
+    with _media_cache_lock:
+        if _media_cache is None:
+            _media_cache = MediaCache(CONFIG.media_cache)
+    return _media_cache
+
+
+@on_cleanup
+def destroy_media_cache():
+    global _media_cache
+    with _media_cache_lock:
+        if _media_cache is not None:
+            _media_cache.close()
+            _media_cache = None
@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import CONFIG
+from .utils import get_logger, on_cleanup
+
+
+PREFIX = 'social2tg_'
+logger = get_logger()
+
+
+class Metrics:
+    """
+    Registry of counters and timers, tagged by labels
+    such as feed, source, target
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels): value
+        self._timers = {}  # (name, labels): [count, sum, max]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            stats = self._timers.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe how long the block takes, failed or not
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels_text(labels):
+        if not labels:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    def to_prometheus(self):
+        """
+        Return the metrics in Prometheus text format
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted((key, list(stats)) for key, stats in self._timers.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                typed.add(name)
+            lines.append(f'{PREFIX}{name}{self._labels_text(labels)} {value}')
+
+        for (name, labels), (count, total, _) in timers:
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name}_seconds summary')
+                typed.add(name)
+            labels_text = self._labels_text(labels)
+            lines.append(f'{PREFIX}{name}_seconds_count{labels_text} {count}')
+            lines.append(f'{PREFIX}{name}_seconds_sum{labels_text} {total:.6f}')
+
+        for (name, labels), (_, _, maximum) in timers:
+            if f'{name}_max' not in typed:
+                lines.append(f'# TYPE {PREFIX}{name}_seconds_max gauge')
+                typed.add(f'{name}_max')
+            lines.append(f'{PREFIX}{name}_seconds_max{self._labels_text(labels)} {maximum:.6f}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Return the metrics as a dict, for the JSON summary of a run
+        """
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            timers = [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': count,
+                    'seconds': round(total, 6),
+                    'avg_seconds': round(total / count, 6) if count else 0,
+                    'max_seconds': round(maximum, 6),
+                }
+                for (name, labels), (count, total, maximum) in sorted(self._timers.items())
+            ]
+
+        now = time.time()
+        return {
+            'started_at': self.started_at,
+            'finished_at': now,
+            'duration_seconds': round(now - self.started_at, 3),
+            'counters': counters,
+            'timers': timers,
+        }
+
+
+METRICS = Metrics()
+inc = METRICS.inc
+observe = METRICS.observe
+timer = METRICS.timer
+
+
+def _write_atomic(path, text):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_textfile():
+    """
+    Write the metrics for node_exporter's textfile collector, if configured
+    """
+    if path := CONFIG.metrics_textfile:
+        _write_atomic(path, METRICS.to_prometheus())
+
+
+def write_summary():
+    """
+    Write JSON summary of the run, if configured
+    """
+    if path := CONFIG.metrics_summary_path:
+        _write_atomic(path, json.dumps(METRICS.summary(), indent=2))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = METRICS.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=None):
+    """
+    Serve the metrics over HTTP in a background thread, if the port is configured
+    """
+    if port := port or CONFIG.metrics_port:
+        server = ThreadingHTTPServer(('', port), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('Serving metrics on port %s', port)
+        return server
+
+
+@on_cleanup
+def export():
+    write_textfile()
+    write_summary()
@@ -0,0 +1,212 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import CONFIG
+from . import metrics
+from .utils import get_logger, on_cleanup, to_seconds
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+logger = get_logger()
+
+PENDING = 'pending'
+SENDING = 'sending'
+FAILED = 'failed'
+
+
+class OutboxItem:
+    """
+    Update waiting in the outbox to be published in the target
+    """
+    def __init__(self, item_id, feed, target, update_id, payload, attempts):
+        self.id = item_id
+        self.feed = feed
+        self.target = target
+        self.update_id = update_id
+        self.payload = payload
+        self.attempts = attempts
+
+    def _str(self):
+        return f"OutboxItem('{self.update_id}' > '{self.target}')"
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+
+class Outbox:
+    """
+    Durable queue of the updates to publish, in Sqlite.
+    Each item is an update for a target of a feed, due at some time:
+    right away for the gathered updates, later for the scheduled ones.
+    A failed item is retried after an exponential backoff,
+    and is given up after "max_attempts".
+    Params: "path", "max_attempts", "backoff" and "max_backoff" (seconds or timedelta)
+    """
+    def __init__(self, params):
+        self.path = str(params['path'])
+        self.max_attempts = params.get('max_attempts', 8)
+        self.backoff = to_seconds(params.get('backoff', 60))
+        self.max_backoff = to_seconds(params.get('max_backoff', 6 * 60 * 60))
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id integer PRIMARY KEY, feed text, target text, update_id text, payload text, '
+                'due_at real, attempts integer DEFAULT 0, status text, last_error text, created_at real)'
+            )
+            cursor.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS outbox_feed_target_update '
+                'ON outbox (feed, target, update_id)'
+            )
+            # Sqlite takes NULLs as distinct, so the scheduled items, having no feed, need their own
+            cursor.execute(
+                'DELETE FROM outbox WHERE feed IS NULL AND id NOT IN '
+                '(SELECT MIN(id) FROM outbox WHERE feed IS NULL GROUP BY target, update_id)'
+            )
+            cursor.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS outbox_scheduled_target_update '
+                'ON outbox (target, update_id) WHERE feed IS NULL'
+            )
+            cursor.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, target, due_at)')
+            # Items being sent when the previous run died are sent again
+            cursor.execute('UPDATE outbox SET status = ? WHERE status = ?', (PENDING, SENDING))
+
+    def __str__(self):
+        return f'Outbox({self.path})'
+
+    @contextmanager
+    def cursor(self):
+        with self._lock, metrics.timer('storage_query', storage=self.path):
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def enqueue(self, update, target, feed=None, due_at=None):
+        """
+        Put the update in the outbox, due at the timestamp or right away.
+        Return whether it's new there
+        """
+        now = time.time()
+        sql = (
+            'INSERT OR IGNORE INTO outbox '
+            '(feed, target, update_id, payload, due_at, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)'
+        )
+        params = (
+            feed.name if feed else None, target.name, update.identifier,
+            json.dumps(update.to_record()), due_at or now, PENDING, now,
+        )
+        with self.cursor() as cursor:
+            cursor.execute(sql, params)
+            is_new = cursor.rowcount > 0
+        if is_new:
+            metrics.inc('outbox_enqueued', target=target.name)
+        return is_new
+
+    def queued_ids(self, feed, target):
+        """
+        Return identifiers of the updates in the outbox for the target, given up or not:
+        the feed's ones, and the scheduled ones any feed publishes
+        """
+        sql = 'SELECT update_id FROM outbox WHERE (feed = ? OR feed IS NULL) AND target = ?'
+        with self.cursor() as cursor:
+            return {row[0] for row in cursor.execute(sql, (feed.name, target.name))}
+
+    def claim_due(self, target, feed=None, limit=100):
+        """
+        Return the items due for the target, in the order they were queued,
+        marking them as being sent. Scheduled items without a feed are taken by any
+        """
+        sql = (
+            'SELECT id, feed, target, update_id, payload, attempts FROM outbox '
+            'WHERE status = ? AND target = ? AND (feed = ? OR feed IS NULL) AND due_at <= ? '
+            'ORDER BY due_at, id LIMIT ?'
+        )
+        with self.cursor() as cursor:
+            rows = cursor.execute(
+                sql, (PENDING, target.name, feed.name if feed else None, time.time(), limit)).fetchall()
+            cursor.executemany(
+                'UPDATE outbox SET status = ? WHERE id = ?', [(SENDING, row[0]) for row in rows])
+
+        return [OutboxItem(*row[:4], json.loads(row[4]), row[5]) for row in rows]
+
+    def mark_sent(self, item):
+        with self.cursor() as cursor:
+            cursor.execute('DELETE FROM outbox WHERE id = ?', (item.id,))
+        metrics.inc('outbox_sent', target=item.target)
+
+    def mark_failed(self, item, error):
+        """
+        Retry the item after the backoff, or give it up
+        """
+        attempts = item.attempts + 1
+        if attempts >= self.max_attempts:
+            status, due_at = FAILED, None
+            logger.error('Giving up %s after %s attempts: %s', item, attempts, error)
+            metrics.inc('outbox_given_up', target=item.target)
+        else:
+            status = PENDING
+            due_at = time.time() + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            logger.info('Retrying %s in %.0f seconds', item, due_at - time.time())
+            metrics.inc('outbox_retries', target=item.target)
+
+        sql = 'UPDATE outbox SET status = ?, attempts = ?, due_at = ?, last_error = ? WHERE id = ?'
+        with self.cursor() as cursor:
+            cursor.execute(sql, (status, attempts, due_at, str(error), item.id))
+
+    def next_due_at(self, feed):
+        """
+        Return the timestamp the earliest pending item the feed can claim is due at, if any
+        """
+        targets = [target.name for target in feed.targets]
+        if not targets:
+            return None
+        sql = (
+            'SELECT MIN(due_at) FROM outbox WHERE status = ? AND (feed = ? OR feed IS NULL) '
+            f'AND target IN ({", ".join("?" * len(targets))})'
+        )
+        with self.cursor() as cursor:
+            row = cursor.execute(sql, (PENDING, feed.name, *targets)).fetchone()
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_outbox():
+    """
+    Return the outbox if configured, creating if necessarry
+    """
+    global _outbox
+    if not CONFIG.outbox:
+        return None
+
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(CONFIG.outbox)
+    return _outbox
+
+
+@on_cleanup
+def destroy_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is not None:
+            _outbox.close()
+            _outbox = None
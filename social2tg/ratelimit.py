@@ -0,0 +1,109 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import CONFIG
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Allows `burst` requests at once, refilled at `rate` requests per second
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for it if necessarry. Return the seconds waited.
+        A missing token is reserved, so the waiters don't hold the lock
+        and are served in the order they came
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class HostLimiter:
+    """
+    Politeness limits of a single host: not more than `concurrency`
+    requests at once, and the request rate of the token bucket
+    """
+    def __init__(self, host, concurrency, rate, burst):
+        self.host = host
+        self.bucket = TokenBucket(rate, burst)
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+
+    def _str(self):
+        return f"HostLimiter('{self.host}')"
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+    @contextmanager
+    def slot(self):
+        """
+        Wait until the host may be requested, and hold it meanwhile
+        """
+        with self._semaphore:
+            self.bucket.acquire()
+            yield
+
+
+def get_host(url):
+    return urlsplit(url).hostname or ''
+
+
+def get_rate_limit(host):
+    """
+    Return rate and burst configured for the host.
+    By default it's one request per delay_after_any_request
+    """
+    limit = CONFIG.rate_limits.get(host) or CONFIG.default_rate_limit or {}
+    rate = limit.get('rate') or 1 / max(CONFIG.delay_after_any_request, 0.001)
+    burst = limit.get('burst', 1)
+    return rate, burst
+
+
+def get_host_limiter(url):
+    """
+    Return limiter of the URL's host, creating if necessarry
+    """
+    host = get_host(url)
+    with _limiters_lock:
+        if host not in _limiters:
+            rate, burst = get_rate_limit(host)
+            _limiters[host] = HostLimiter(host, CONFIG.max_requests_per_host, rate, burst)
+        return _limiters[host]
+
+
+def host_slot(url):
+    """
+    Context manager holding a request slot of the URL's host
+    """
+    return get_host_limiter(url).slot()
+
+
+def acquire(url):
+    """
+    Take a request token of the URL's host, for requests made by third-party libs
+    """
+    return get_host_limiter(url).bucket.acquire()
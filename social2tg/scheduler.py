@@ -0,0 +1,166 @@
+import heapq
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import CONFIG
+from . import metrics
+from .common import Feed, SourceRegistry
+from .outbox import get_outbox
+from .utils import get_logger, to_seconds
+
+
+logger = get_logger()
+
+
+class FeedScheduler:
+    """
+    Process many feeds at once in a pool of workers.
+    Politeness to the scraped hosts is kept by the host limiters.
+    A source used by several feeds is fetched once, see SourceRegistry
+    """
+    def __init__(self, feed_names, concurrency=None):
+        self.feed_names = list(feed_names)
+        self.concurrency = concurrency or CONFIG.max_concurrent_feeds
+        self.registry = SourceRegistry()
+
+    @staticmethod
+    def _process(feed):
+        try:
+            feed.process()
+        finally:
+            feed.close()
+
+    def run(self):
+        """
+        Process all the feeds, logging the failed ones.
+        All the feeds are created first, so each shared source
+        knows every feed it's gathered for
+        """
+        feeds = []
+        for name in self.feed_names:
+            try:
+                feeds.append(Feed(name, CONFIG.feeds[name], self.registry))
+            except Exception as exc:
+                logger.error('Feed %s failed: %s', name, exc)
+                logger.exception(exc)
+
+        workers = max(1, min(self.concurrency, len(feeds)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='feed') as pool:
+            futures = {pool.submit(self._process, feed): feed.name for feed in feeds}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    logger.error('Feed %s failed: %s', futures[future], exc)
+                    logger.exception(exc)
+
+
+class FeedDaemon:
+    """
+    Long-running mode: feeds, their clients and storages are created once
+    and kept warm, each feed is processed every its "interval"
+    (CONFIG.feed_interval by default). Between that, the feeds publish
+    the outbox items when they become due. Stops gracefully on SIGINT and SIGTERM
+    """
+    OUTBOX_POLL = 5  # seconds between checks of the outbox, at least
+
+    def __init__(self, feed_names, concurrency=None):
+        self.registry = SourceRegistry(CONFIG.shared_updates_max_age)
+        self.feeds = {name: Feed(name, CONFIG.feeds[name], self.registry) for name in feed_names}
+        self.concurrency = concurrency or CONFIG.max_concurrent_feeds
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    def interval(self, feed):
+        return to_seconds(feed.params.get('interval', CONFIG.feed_interval))
+
+    def stop(self, *args):
+        logger.info('Stopping, waiting for the feeds in progress')
+        self._stop.set()
+        self._wakeup.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+    def _process(self, feed):
+        try:
+            feed.process()
+        except Exception as exc:
+            logger.error('%s failed: %s', feed, exc)
+            logger.exception(exc)
+        finally:
+            metrics.write_textfile()
+            self._wakeup.set()
+
+    def _drain_outbox(self, feed):
+        try:
+            feed.drain_outbox()
+        except Exception as exc:
+            logger.error('%s failed publishing the outbox: %s', feed, exc)
+            logger.exception(exc)
+        finally:
+            self._wakeup.set()
+
+    def _outbox_timeout(self, pool, running, draining):
+        """
+        Let the idle feeds with due outbox items publish them.
+        Return seconds until the next check, the busy feeds wake the loop when done
+        """
+        if not (outbox := get_outbox()):
+            return None
+
+        due_in = None
+        now = time.time()
+        for name, feed in self.feeds.items():
+            if name in running or name in draining:
+                continue
+            if (next_due_at := outbox.next_due_at(feed)) is None:
+                continue
+            if next_due_at <= now:
+                draining[name] = pool.submit(self._drain_outbox, feed)
+            else:
+                due_in = next_due_at - now if due_in is None else min(due_in, next_due_at - now)
+        return None if due_in is None else max(due_in, self.OUTBOX_POLL)
+
+    def run(self):
+        """
+        Process the feeds when they are due, until stopped
+        """
+        queue = [(time.monotonic(), name) for name in self.feeds]
+        heapq.heapify(queue)
+        running = {}  # name: (future, started at)
+        draining = {}  # name: future
+        waiting = []  # names of the due feeds still publishing their outbox
+
+        workers = max(1, min(self.concurrency, len(self.feeds)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='feed') as pool:
+            while not self._stop.is_set():
+                self._wakeup.clear()
+                now = time.monotonic()
+
+                for name, (future, started_at) in list(running.items()):
+                    if future.done():
+                        del running[name]
+                        due_at = max(started_at + self.interval(self.feeds[name]), now)
+                        heapq.heappush(queue, (due_at, name))
+                for name, future in list(draining.items()):
+                    if future.done():
+                        del draining[name]
+
+                while queue and queue[0][0] <= now:
+                    waiting.append(heapq.heappop(queue)[1])
+                # A feed publishing its outbox is processed once that's done, which wakes the loop
+                for name in [name for name in waiting if name not in draining]:
+                    waiting.remove(name)
+                    running[name] = (pool.submit(self._process, self.feeds[name]), now)
+
+                timeout = queue[0][0] - now if queue else None
+                if (outbox_timeout := self._outbox_timeout(pool, running, draining)) is not None:
+                    timeout = outbox_timeout if timeout is None else min(timeout, outbox_timeout)
+                self._wakeup.wait(timeout)
+
+        for feed in self.feeds.values():
+            feed.close()
@@ -1,85 +1,258 @@
 import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
+from datetime import datetime
 
 import CONFIG
+from . import metrics
+from .utils import to_seconds
 
 
 class Storage:
     """
-    Base for any storage class
+    Base for any storage class.
+    Updates are remembered as published per (feed, target). Records without
+    a target are left by the older versions, they count for all the targets
     """
     def __init__(self, params):
         self.params = params
 
-    def remember_published(self, update, feed):
+    def remember_published(self, update, feed, target=None):
         raise NotImplementedError
 
-    def find_published(self, update, feed):
+    def find_published(self, update, feed, target=None):
+        return self.find_published_id(update.identifier, feed, target)
+
+    def find_published_id(self, identifier, feed, target=None):
+        raise NotImplementedError
+
+    def remember_published_many(self, updates, feed, target=None):
+        for update in updates:
+            self.remember_published(update, feed, target)
+
+    def find_published_many(self, updates, feed, target=None):
+        """
+        Return the set of identifiers of the updates which are already published
+        """
+        return {upd.identifier for upd in updates if self.find_published(upd, feed, target)}
+
+    def load_published(self, feed, target):
+        """
+        Return the set of all the identifiers published by the feed in the target
+        """
+        raise NotImplementedError
+
+    def get_watermark(self, source, feed):
+        """
+        Return (identifier, date) of the newest update of the source
+        the feed is done with, if any
+        """
+        raise NotImplementedError
+
+    def set_watermark(self, source, feed, identifier, date):
         raise NotImplementedError
 
+    def close(self):
+        pass
+
+
+def _name(obj):
+    return obj.name if obj is not None else None
+
 
 class MemoryStorage(Storage):
     """
-    In-memory storage. Suitable only for temporary testing usage
+    In-memory storage, indexed by (feed, target, update_id).
+    Optional params: "max_size" entries and "ttl" (seconds or timedelta),
+    the oldest entries are evicted when exceeded
     """
     def __init__(self, params):
         super().__init__(params)
+        self.max_size = params.get('max_size')
+        self.ttl = to_seconds(params.get('ttl'))
+
+        self._lock = threading.Lock()
         self.mem = {
-            'published': [],
+            'published': OrderedDict(),
+            'watermarks': {},
         }
 
-    def remember_published(self, update, feed):
+    def _expired(self, entry, now):
+        return self.ttl is not None and entry['at'] + self.ttl <= now
+
+    def _evict(self, now):
+        published = self.mem['published']
+        while published:
+            key, entry = next(iter(published.items()))
+            too_many = self.max_size is not None and len(published) > self.max_size
+            if not too_many and not self._expired(entry, now):
+                break
+            del published[key]
+
+    def remember_published(self, update, feed, target=None):
+        now = time.time()
         entry = {
             'update_id': update.identifier,
             'feed': feed.name,
-            'at': int(time.time()),
+            'target': _name(target),
+            'at': int(now),
         }
-        self.mem['published'].append(entry)
+        key = (feed.name, _name(target), update.identifier)
+        with self._lock:
+            self.mem['published'][key] = entry
+            self.mem['published'].move_to_end(key)
+            self._evict(now)
+
+    def _get(self, key, now):
+        entry = self.mem['published'].get(key)
+        if entry is not None and self._expired(entry, now):
+            del self.mem['published'][key]
+            entry = None
+        return entry
+
+    def find_published_id(self, identifier, feed, target=None):
+        now = time.time()
+        with self._lock:
+            entry = self._get((feed.name, _name(target), identifier), now)
+            if entry is None and target is not None:
+                entry = self._get((feed.name, None, identifier), now)
+        return entry
+
+    def load_published(self, feed, target):
+        now = time.time()
+        with self._lock:
+            return {
+                entry['update_id'] for entry in self.mem['published'].values()
+                if entry['feed'] == feed.name
+                and entry['target'] in (target.name, None)
+                and not self._expired(entry, now)
+            }
 
-    def find_published(self, update, feed):
-        for entry in self.mem['published']:
-            update_found = entry['update_id'] == update.identifier
-            feed_found = entry['feed'] == feed.name
-            if update_found and feed_found:
-                return entry
+    def get_watermark(self, source, feed):
+        return self.mem['watermarks'].get((feed.name, source.name))
+
+    def set_watermark(self, source, feed, identifier, date):
+        self.mem['watermarks'][(feed.name, source.name)] = (identifier, date)
 
 
 class SqliteStorage(Storage):
+    """
+    Storage in Sqlite database, keeping one connection open for all the queries
+    """
+    CHUNK = 500  # keep below the limit of SQL variables
 
     def __init__(self, params):
         super().__init__(params)
         self.path = params['path']
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
 
-        sql = 'CREATE TABLE IF NOT EXISTS published (update_id text, feed text, at integer)'
-        with get_sqlite_cursor(self.path) as cursor:
-            cursor.execute(sql, params)
+        with self.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS published (update_id text, feed text, at integer, target text)')
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks '
+                '(feed text, source text, update_id text, date text, PRIMARY KEY (feed, source))')
+            self._migrate(cursor)
 
     def __str__(self):
         return f'SqliteStorage({self.path})'
 
-    def remember_published(self, update, feed):
-        sql = 'INSERT INTO published (update_id, feed, at) VALUES (?, ?, ?)'
-        params = (update.identifier, feed.name, int(time.time()))
-        with get_sqlite_cursor(self.path) as cursor:
-            cursor.execute(sql, params)
+    def _migrate(self, cursor):
+        """
+        Bring the tables of the older versions up to date
+        """
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(published)')]
+        if 'target' not in columns:
+            cursor.execute('ALTER TABLE published ADD COLUMN target text')
+
+        sql = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'published_feed_target_update'"
+        if cursor.execute(sql).fetchone():
+            return
+
+        cursor.execute('DROP INDEX IF EXISTS published_update_feed')
+        cursor.execute(
+            'DELETE FROM published WHERE rowid NOT IN '
+            '(SELECT MIN(rowid) FROM published GROUP BY feed, target, update_id)'
+        )
+        cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS published_feed_target_update '
+            'ON published (feed, target, update_id)'
+        )
+
+    @contextmanager
+    def cursor(self):
+        """
+        Yield a cursor, committing when done and rolling back on error
+        """
+        with self._lock, metrics.timer('storage_query', storage=self.path):
+            cursor = self._conn.cursor()
+            try:
+                yield cursor
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def remember_published(self, update, feed, target=None):
+        self.remember_published_many([update], feed, target)
 
-    def find_published(self, update, feed):
-        sql = 'SELECT * FROM published WHERE update_id = ? AND feed = ?'
-        params = (update.identifier, feed.name)
-        with get_sqlite_cursor(self.path) as cursor:
+    def remember_published_many(self, updates, feed, target=None):
+        sql = 'INSERT OR IGNORE INTO published (update_id, feed, target, at) VALUES (?, ?, ?, ?)'
+        now = int(time.time())
+        params = [(update.identifier, feed.name, _name(target), now) for update in updates]
+        with self.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    def find_published_id(self, identifier, feed, target=None):
+        sql = 'SELECT * FROM published WHERE update_id = ? AND feed = ? AND (target IS ? OR target IS NULL)'
+        params = (identifier, feed.name, _name(target))
+        with self.cursor() as cursor:
             cursor.execute(sql, params)
             result = cursor.fetchone()
         return result
 
+    def find_published_many(self, updates, feed, target=None):
+        identifiers = list({update.identifier for update in updates})
+        found = set()
 
-@contextmanager
-def get_sqlite_cursor(path):
-    """
-    Emulate context manager since Sqlite lib doesn't have it
-    """
-    conn = sqlite3.connect(path)
-    cursor = conn.cursor()
-    yield cursor
-    conn.commit()
-    conn.close()
+        with self.cursor() as cursor:
+            for start in range(0, len(identifiers), self.CHUNK):
+                chunk = identifiers[start:start+self.CHUNK]
+                marks = ', '.join('?' * len(chunk))
+                sql = (
+                    'SELECT update_id FROM published WHERE feed = ? AND (target IS ? OR target IS NULL) '
+                    f'AND update_id IN ({marks})'
+                )
+                cursor.execute(sql, [feed.name, _name(target), *chunk])
+                found.update(row[0] for row in cursor.fetchall())
+
+        return found
+
+    def load_published(self, feed, target):
+        sql = 'SELECT update_id FROM published WHERE feed = ? AND (target = ? OR target IS NULL)'
+        with self.cursor() as cursor:
+            cursor.execute(sql, (feed.name, target.name))
+            return {row[0] for row in cursor.fetchall()}
+
+    def get_watermark(self, source, feed):
+        sql = 'SELECT update_id, date FROM watermarks WHERE feed = ? AND source = ?'
+        with self.cursor() as cursor:
+            row = cursor.execute(sql, (feed.name, source.name)).fetchone()
+        if row:
+            return row[0], datetime.fromisoformat(row[1])
+
+    def set_watermark(self, source, feed, identifier, date):
+        sql = 'INSERT OR REPLACE INTO watermarks (feed, source, update_id, date) VALUES (?, ?, ?, ?)'
+        with self.cursor() as cursor:
+            cursor.execute(sql, (feed.name, source.name, identifier, date.isoformat()))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
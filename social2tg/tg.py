@@ -1,17 +1,43 @@
+import asyncio
 import datetime
-import os
+import threading
 import time
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
 
-import telegram
-from telegram.error import RetryAfter
-from telethon.errors.rpcerrorlist import FloodWaitError
-from telethon.sync import TelegramClient
-
+from . import metrics
 from .common import Target
-from .utils import get_logger
+from .media import get_media_cache
+from .utils import get_logger, on_cleanup
 
 
 logger = get_logger()
+_telethon_sessions = {}
+_telethon_lock = threading.Lock()
+_chat_locks = {}  # (bot or session, chat_id): lock held while sending there
+_chat_last_sent = {}  # (bot or session, chat_id): monotonic time of the last message
+_chats_lock = threading.Lock()
+_uploads = {}  # (bot, media URL): [lock held while uploading, users of the lock]
+_uploads_lock = threading.Lock()
+
+
+@contextmanager
+def uploading(bot, url):
+    """
+    Hold the media for uploading by the bot, the other targets wait for its file_id
+    """
+    key = (bot, url)
+    with _uploads_lock:
+        entry = _uploads.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _uploads_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _uploads[key]
 
 
 class TelegramTarget(Target):
@@ -20,6 +46,34 @@ class TelegramTarget(Target):
     """
     caption_limit = 1024
     text_limit = 4096
+    min_interval = 2  # seconds between two messages in the chat
+
+    @property
+    def chat_key(self):
+        """
+        The chat with the bot or session sending there,
+        the targets with the same key keep the interval together
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def _paced(self):
+        """
+        Hold the chat for sending, once the minimal interval since its last message passed
+        """
+        key = self.chat_key
+        with _chats_lock:
+            lock = _chat_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            interval = self.params.get('min_interval', self.min_interval)
+            wait = _chat_last_sent.get(key, 0) + interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                yield
+            finally:
+                _chat_last_sent[key] = time.monotonic()
 
     def to_target(self, text, footer, media):
         footer = '' if self.params.get('no_footer') else footer
@@ -34,32 +88,107 @@ class TelegramTarget(Target):
         return text, footer, media
 
 
+class TelethonSession:
+    """
+    Telethon client kept connected for the whole run,
+    working in its own thread with its own event loop
+    """
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name=f'telethon-{session}', daemon=True)
+        self._thread.start()
+        self.client = self.run(self._connect(session, api_id, api_hash))
+
+    def _str(self):
+        return f"TelethonSession('{self.session}')"
+
+    def __str__(self):
+        return self._str()
+
+    def __repr__(self):
+        return self._str()
+
+    async def _connect(self, session, api_id, api_hash):
+        from telethon import TelegramClient
+        client = TelegramClient(session, api_id, api_hash)
+        await client.start()
+        return client
+
+    def run(self, coro):
+        """
+        Run the coroutine in the session's loop and wait for the result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        try:
+            self.run(self.client.disconnect())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+def get_telethon_session(params):
+    """
+    Return connected Telethon session, creating if necessarry
+    """
+    key = params['session']
+    with _telethon_lock:
+        if key not in _telethon_sessions:
+            logger.info('Connecting Telethon session %s', key)
+            _telethon_sessions[key] = TelethonSession(
+                params['session'], params['api_id'], params['api_hash'])
+        return _telethon_sessions[key]
+
+
+@on_cleanup
+def destroy_telethon_sessions():
+    with _telethon_lock:
+        while _telethon_sessions:
+            _, session = _telethon_sessions.popitem()
+            logger.info('Disconnecting %s', session)
+            session.close()
+
+
 class TelethonChatTarget(TelegramTarget):
     """
     Uses Telethon lib and Telegram Core API
     """
     def _tg_exec(self, action, *args):
         """
-        Execute provided action with provided args
+        Execute provided action with provided args,
+        using the session shared by all the targets of the run.
+        The session's loop takes the actions from many threads, so only the chat is held
         """
-        with TelegramClient(self.params['session'],
-                            self.params['api_id'],
-                            self.params['api_hash']) as client:
+        from telethon.errors.rpcerrorlist import FloodWaitError
+
+        session = get_telethon_session(self.params)
+        with self._paced():
             try:
-                action(client, *args)
+                with metrics.timer('telegram_send', target=self.name):
+                    resp = session.run(action(session.client, *args))
             except FloodWaitError as exc:
+                logger.info('Flood limit detected, waiting for %s seconds', exc.seconds)
+                metrics.inc('telegram_flood_wait_seconds', exc.seconds + 1, target=self.name)
                 time.sleep(exc.seconds + 1)
-                action(client, *args)
-            time.sleep(2)
+                with metrics.timer('telegram_send', target=self.name):
+                    resp = session.run(action(session.client, *args))
+        return resp
+
+    @property
+    def chat_key(self):
+        return self.params['session'], self.params['chat_id']
 
-    def _publish(self, client, update):
+    async def _publish(self, client, update):
         """
         Action for publishing a post
         """
         text, footer, media = update.to_internal()
         text, footer, media = self.to_target(text, footer, media)
         if text or media:  # TODO: add media
-            resp = client.send_message(self.params['chat_id'], text + footer)
+            resp = await client.send_message(self.params['chat_id'], text + footer)
             return True
 
     def publish(self, update):
@@ -77,37 +206,43 @@ class PtbTarget(TelegramTarget):
 class PtbChatTarget(PtbTarget):
     """
     Uses python-telegram-bot lib and Telegram Bot API,
-    send update in a chat (channel, group, or user)
+    send update in a chat (channel, group, or user).
+    Optional "base_url" and "base_file_url" params point the bot
+    to another Bot API server, e.g. a local one
     """
     def __init__(self, name, params):
+        import telegram
         super().__init__(name, params)
-        self.bot = telegram.Bot(token=params['bot_token'])
+        # The proxies are given to the sources' clients only, Telegram is reached directly
+        self.bot = telegram.Bot(
+            token=params['bot_token'],
+            base_url=params.get('base_url'),
+            base_file_url=params.get('base_file_url'),
+        )
 
     def _tg_exec(self, action, *args):
         """
         Execute provided action
         """
-        # Clear proxies
-        http_proxy, https_proxy = os.environ['http_proxy'], os.environ['https_proxy']
-        del os.environ['http_proxy']
-        del os.environ['https_proxy']
+        from telegram.error import BadRequest, RetryAfter
 
         resp = None
-        try:
+        with self._paced():
             try:
-                resp = action(*args)
-                time.sleep(2)
-            except RetryAfter as exc:
-                wait = int(exc.retry_after)
-                logger.info('Flood limit detected, waiting for %s seconds', wait)
-                time.sleep(wait + 1)
-                resp = action(*args)
+                try:
+                    with metrics.timer('telegram_send', target=self.name):
+                        resp = action(*args)
+                except RetryAfter as exc:
+                    wait = int(exc.retry_after)
+                    logger.info('Flood limit detected, waiting for %s seconds', wait)
+                    metrics.inc('telegram_flood_wait_seconds', wait + 1, target=self.name)
+                    time.sleep(wait + 1)
+                    with metrics.timer('telegram_send', target=self.name):
+                        resp = action(*args)
 
-        except telegram.error.BadRequest as exc:
-            logger.error("Fail executing TG action %s: %s", action, exc)
-
-        # Return proxies
-        os.environ['http_proxy'], os.environ['https_proxy'] = http_proxy, https_proxy
+            except BadRequest as exc:
+                logger.error("Fail executing TG action %s: %s", action, exc)
+                metrics.inc('telegram_errors', target=self.name)
 
         return resp
 
@@ -130,14 +265,68 @@ class PtbChatTarget(PtbTarget):
         if text or media:
             text = text + footer
 
-            ptb_media = []
-            if media:
-                md_0 = media.pop(0)
-                ptb_md_0 = md_0.convert_to_ptb(caption=text)
-                ptb_media = [ptb_md_0] + [md.convert_to_ptb() for md in media]
+            with ExitStack() as uploads:
+                # The media not uploaded by the bot yet are held till it's done, once for all the targets
+                if cache := get_media_cache():
+                    urls = {md.url for md in media if not cache.get_file_id(self.bot_key, md.url)}
+                    for url in sorted(urls):
+                        uploads.enter_context(uploading(self.bot_key, url))
 
-            resp = self._tg_exec(self._publish, text, ptb_media)
-            return True
+                ptb_media = []
+                if media:
+                    with ExitStack() as stack:
+                        sources = [self._media_source(md) for md in media]
+                        # Bot API takes local files only as uploads, PTB reads them right away
+                        sources = [
+                            stack.enter_context(open(src, 'rb')) if isinstance(src, Path) else src
+                            for src in sources
+                        ]
+                        ptb_media = [media[0].convert_to_ptb(caption=text, media=sources[0])]
+                        ptb_media += [
+                            md.convert_to_ptb(media=src) for md, src in zip(media[1:], sources[1:])]
+
+                resp = self._tg_exec(self._publish, text, ptb_media)
+                if resp and media:
+                    self._remember_file_ids(media, resp)
+            # No response when Telegram refused the message
+            return resp is not None
+
+    @property
+    def bot_key(self):
+        """
+        ID of the bot, which is the start of its token
+        """
+        return self.params['bot_token'].split(':')[0]
+
+    @property
+    def chat_key(self):
+        return self.bot_key, self.params['chat_id']
+
+    def _media_source(self, media):
+        """
+        Return what to send instead of the media URL: file_id of the already
+        uploaded file, or the downloaded file. None means the URL itself
+        """
+        if not (cache := get_media_cache()):
+            return None
+
+        if file_id := cache.get_file_id(self.bot_key, media.url):
+            return file_id
+
+        try:
+            return cache.download(media.url)
+        except Exception as exc:
+            logger.error('Cant download %s, sending the URL: %s', media, exc)
+
+    def _remember_file_ids(self, media, messages):
+        if not (cache := get_media_cache()):
+            return
+
+        for md, message in zip(media, messages):
+            if message.photo:
+                cache.remember_file_id(self.bot_key, md.url, message.photo[-1].file_id)
+            elif message.video:
+                cache.remember_file_id(self.bot_key, md.url, message.video.file_id)
 
 
 class PtbBotTarget(PtbTarget):
@@ -1,11 +1,14 @@
 import logging
 import re
+from datetime import timedelta
 from importlib import import_module
 
 import CONFIG
 
 
 _LOGGER = None
+_CLEANUPS = []
+_SHORTCODE_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
 
 
 def import_string(dotted_path):
@@ -38,6 +41,32 @@ def get_logger():
     return _LOGGER
 
 
+def on_cleanup(func):
+    """
+    Register the function to be called at the end of the job, by common.cleanup()
+    """
+    if func not in _CLEANUPS:
+        _CLEANUPS.append(func)
+    return func
+
+
+def run_cleanups():
+    for func in _CLEANUPS:
+        try:
+            func()
+        except Exception as exc:
+            get_logger().error('Cleanup %s failed: %s', func.__name__, exc)
+
+
+def to_seconds(value):
+    """
+    Return seconds of the interval, given as a number or timedelta
+    """
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
 def find_elem(soup, selector, index=0):
     """
     Find an element in the soup by the selector
@@ -48,3 +77,16 @@ def find_elem(soup, selector, index=0):
 
 def ip_in_string(string):
     return re.search(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}", string)
+
+
+def media_id_to_shortcode(media_id):
+    """
+    Convert numeric Instagram media ID (optionally with "_<owner_id>")
+    to the short code used in the post URL
+    """
+    number = int(str(media_id).split('_')[0])
+    shortcode = ''
+    while number:
+        number, idx = divmod(number, 64)
+        shortcode = _SHORTCODE_ALPHABET[idx] + shortcode
+    return shortcode